@@ -1,12 +1,23 @@
+from collections import defaultdict
+from functools import partial
+from hashlib import sha1
 import numpy as np
+import os
 from pandas import DataFrame, Series
+import re
 import scipy.sparse as sparse
-from sqlalchemy.sql import bindparam, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import with_polymorphic
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql import bindparam, func, select
+from types import CodeType, FunctionType, MethodType
+import zlib
 
 from .features import get_span_feats
-from .models import GoldLabel, GoldLabelKey, Label, LabelKey, Feature, FeatureKey, Candidate
-from .models.meta import new_sessionmaker
-from .udf import UDF, UDFRunner
+from .models import GoldLabel, GoldLabelKey, Label, LabelKey, Feature, FeatureKey, Candidate, Context
+from .models import LabelKeyFingerprint, get_annotation_runs
+from .models.meta import new_sessionmaker, rows_per_statement, snorkel_conn_string, snorkel_postgres
+from .udf import ContextIdBatch, ID_BATCH_SIZE, UDF, UDFRunner
 from .utils import (
     matrix_conflicts,
     matrix_coverage,
@@ -17,6 +28,23 @@ from .utils import (
     matrix_tn
 )
 
+# Number of annotation rows fetched from the DB at a time when loading a matrix
+ANNOTATION_BATCH_SIZE = 100000
+
+# Number of Annotations buffered by the reducer before inserting them
+REDUCE_BATCH_SIZE = 10000
+
+# Name of the AnnotationKey of each column of a hashed feature space, see FeatureAnnotator
+HASHED_KEY_NAME = 'hash:%d'
+
+# Directory of the files of annotation matrices loaded with cache=True
+ANNOTATION_CACHE_DIR = os.environ['SNORKELCACHE'] if 'SNORKELCACHE' in os.environ and os.environ['SNORKELCACHE'] != '' \
+    else '.snorkel_cache'
+
+# Relationships of Contexts to their parent Contexts, with the attributes holding the ids of the parents, which are
+# loaded along with a CandidateIdBatch
+PARENT_ATTRIBS = (('sentence', 'sentence_id'), ('document', 'document_id'))
+
 
 class csr_AnnotationMatrix(sparse.csr_matrix):
     """
@@ -92,15 +120,17 @@ class csr_LabelMatrix(csr_AnnotationMatrix):
 
 class Annotator(UDFRunner):
     """Abstract class for annotating candidates and persisting these annotations to DB"""
-    def __init__(self, annotation_class, annotation_key_class, f):
+    def __init__(self, annotation_class, annotation_key_class, f, **kwargs):
         self.annotation_class     = annotation_class
         self.annotation_key_class = annotation_key_class
+        self.output_table         = annotation_class.__tablename__
         super(Annotator, self).__init__(AnnotatorUDF,
                                         annotation_class=annotation_class,
                                         annotation_key_class=annotation_key_class,
-                                        f=f)
+                                        f=f,
+                                        **kwargs)
 
-    def apply(self, split, key_group=0, replace_key_set=True, **kwargs):
+    def apply(self, split, key_group=0, replace_key_set=True, batch_size=ID_BATCH_SIZE, **kwargs):
 
         # If we are replacing the key set, make sure the reducer key id cache is cleared!
         if replace_key_set:
@@ -109,16 +139,21 @@ class Annotator(UDFRunner):
         # Get the cids based on the split, and also the count
         SnorkelSession = new_sessionmaker()
         session        = SnorkelSession()
-        cids_query     = session.query(Candidate.id).filter(Candidate.split == split)
+        cids_query     = session.query(Candidate.id).filter(Candidate.split == split).order_by(Candidate.id)
 
         # Note: In the current UDFRunner implementation, we load all these into memory and fill a
         # multiprocessing JoinableQueue with them before starting... so might as well load them here and pass in.
         # Also, if we try to pass in a query iterator instead, with AUTOCOMMIT on, we get a TXN error...
-        cids       = cids_query.all()
-        cids_count = len(cids)
-        
+        # With no functions to apply (an incremental LabelAnnotator run without changes), nothing needs to be loaded
+        lf_names = kwargs.get('lf_names')
+        cids     = [] if lf_names is not None and len(lf_names) == 0 else [cid for cid, in cids_query.all()]
+
+        # The Candidates are given to the UDF(s) in batches, to which batch functions (see batch_lf) are applied at once
+        batches = [CandidateIdBatch(cids[i:i+batch_size]) for i in range(0, len(cids), batch_size)]
+
         # Run the Annotator
-        super(Annotator, self).apply(cids, split=split, key_group=key_group, replace_key_set=replace_key_set, count=cids_count, **kwargs)
+        super(Annotator, self).apply(batches, split=split, key_group=key_group, replace_key_set=replace_key_set,
+                                     count=len(batches), **kwargs)
 
         # Load the matrix
         return self.load_matrix(session, split=split, key_group=key_group)
@@ -151,105 +186,239 @@ class Annotator(UDFRunner):
         raise NotImplementedError()
 
 
+class CandidateIdBatch(ContextIdBatch):
+    """
+    A batch of Candidate ids, loaded together with the Contexts of the Candidates' arguments and their parent
+    Contexts (e.g. Sentences and Documents) in a few queries, so that these are not lazily loaded one at a time.
+    """
+    def __init__(self, ids):
+        super(CandidateIdBatch, self).__init__(Candidate, ids)
+
+    def load(self, session):
+        """Returns the Candidates of the batch, ordered by id"""
+        candidates = _load_by_ids(session, Candidate, self.ids)
+        candidates.sort(key=lambda c: c.id)
+
+        # Load the argument Contexts, then their parents level by level
+        contexts = {}
+        ids      = set(getattr(c, arg + '_id') for c in candidates for arg in c.__argnames__)
+        while ids:
+            level = _load_by_ids(session, Context, ids)
+            contexts.update((x.id, x) for x in level)
+            ids   = set(getattr(x, id_attrib, None) for x in level for _, id_attrib in PARENT_ATTRIBS)
+            ids   = ids.difference(contexts, [None])
+
+        # Set the many-to-one relationships directly, so that they are not lazily loaded; this also keeps the
+        # Contexts referenced, as the session's identity map only holds weak references
+        for c in candidates:
+            for arg in c.__argnames__:
+                if getattr(c, arg + '_id') in contexts:
+                    set_committed_value(c, arg, contexts[getattr(c, arg + '_id')])
+        for x in contexts.itervalues():
+            for attrib, id_attrib in PARENT_ATTRIBS:
+                if getattr(x, id_attrib, None) in contexts:
+                    set_committed_value(x, attrib, contexts[getattr(x, id_attrib)])
+        return candidates
+
+
+def _load_by_ids(session, cls, ids):
+    """Returns the objects of cls (with their subclass columns) with the given ids, with one query per ID_BATCH_SIZE"""
+    entity  = with_polymorphic(cls, '*')
+    ids     = [id for id in ids if id is not None]
+    objects = []
+    for i in range(0, len(ids), ID_BATCH_SIZE):
+        objects.extend(session.query(entity).filter(entity.id.in_(ids[i:i+ID_BATCH_SIZE])).all())
+    return objects
+
+
 class AnnotatorUDF(UDF):
-    def __init__(self, annotation_class, annotation_key_class, f, **kwargs):
+    def __init__(self, annotation_class, annotation_key_class, f, hash_dim=None, **kwargs):
         self.annotation_class     = annotation_class
         self.annotation_key_class = annotation_key_class
-        self.anno_generator       = _to_annotation_generator(f) if hasattr(f, '__iter__') else f
+        self.hash_dim             = hash_dim
+
+        # Functions marked with batch_lf are applied to whole CandidateBatches, separately from the others
+        if hasattr(f, '__iter__'):
+            self.batch_fns      = [fn for fn in f if getattr(fn, 'batch', False)]
+            self.anno_generator = _to_annotation_generator([fn for fn in f if not getattr(fn, 'batch', False)])
+        else:
+            self.batch_fns      = []
+            self.anno_generator = f
 
-        # For caching key ids during the reduce step
+        # For caching key ids during the reduce step, and buffering Annotations to insert
         self.key_cache = {}
+        self.buffer    = []
 
         super(AnnotatorUDF, self).__init__(**kwargs)
 
-    def apply(self, cid, **kwargs):
+    def apply(self, candidates, lf_names=None, **kwargs):
         """
-        Applies a given function to a Candidate, yielding a set of Annotations as key_name, value pairs
+        Applies the given function(s) to a batch of Candidates, yielding a set of Annotations as cid, key_name, value
+        triples. Functions marked with batch_lf are applied once, to a CandidateBatch of all the Candidates.
 
-        Note: Accepts a candidate _id_ as argument, because of issues with putting Candidate subclasses
-        into Queues (can't pickle...)
-        """
-        seen = set()
-        cid = cid[0]
-        c    = self.session.query(Candidate).filter(Candidate.id == cid).one()
-        for key_name, value in self.anno_generator(c):
+        If lf_names is not None, only the functions (of a list of functions) with these names are applied.
+        If hash_dim is not None, the key names are hashed to integers in [0, hash_dim), see hash_key_name.
 
-            # Note: Make sure no duplicates emitted here!
-            if (cid, key_name) not in seen:
-                seen.add((cid, key_name))
-                yield cid, key_name, value
+        Note: The Candidates are loaded by the UDF from the ids in a CandidateIdBatch, because of issues with putting
+        Candidate subclasses into Queues (can't pickle...)
+        """
+        annotations = self._annotate(candidates, lf_names)
+        return annotations if self.hash_dim is None else _hash_annotations(annotations, self.hash_dim)
+
+    def _annotate(self, candidates, lf_names):
+        seen  = set()
+        batch = None
+        for fn in self.batch_fns:
+            if lf_names is None or fn.__name__ in lf_names:
+                batch  = CandidateBatch(candidates) if batch is None else batch
+                values = fn(batch)
+                if len(values) != len(candidates):
+                    raise ValueError("Batch function %s returned %s values for %s candidates." %
+                                     (fn.__name__, len(values), len(candidates)))
+                values = values.tolist() if isinstance(values, np.ndarray) else values
+                for c, value in zip(candidates, values):
+                    if (c.id, fn.__name__) not in seen:
+                        seen.add((c.id, fn.__name__))
+                        yield c.id, fn.__name__, value
+
+        for c in candidates:
+            cid         = c.id
+            annotations = self.anno_generator(c) if lf_names is None else self.anno_generator(c, names=lf_names)
+            for key_name, value in annotations:
+
+                # Note: Make sure no duplicates emitted here!
+                if (cid, key_name) not in seen:
+                    seen.add((cid, key_name))
+                    yield cid, key_name, value
+
+        # Release the batch's objects, so that the session does not grow over the run
+        self.session.expunge_all()
+
+    def get_inputs(self, x):
+        """Loads the Candidates of a CandidateIdBatch, to be annotated as one batch"""
+        return [x.load(self.session)]
+
+    def reduce(self, y, **kwargs):
+        """
+        Buffers an Annotation, as a cid, key_name, value triple, to be inserted into the database by flush(),
+        which is called for every REDUCE_BATCH_SIZE Annotations.
+        """
+        self.buffer.append(y)
+        if len(self.buffer) >= REDUCE_BATCH_SIZE:
+            self.flush(**kwargs)
 
-    def reduce(self, y, clear, key_group, replace_key_set, **kwargs):
+    def flush(self, clear, key_group, replace_key_set, fingerprints=None, **kwargs):
         """
-        Inserts Annotations into the database.
+        Inserts the buffered Annotations into the database.
         For Annotations with unseen AnnotationKeys (in key_group, if not None), either adds these
         AnnotationKeys if create_new_keyset is True, else skips these Annotations.
+        New LabelKeys get their fingerprint from fingerprints, if given.
         """
-        cid, key_name, value = y
-
-        # Prepares queries
-        # Annoation updating only needs to be done if clear=False
+        if len(self.buffer) == 0:
+            return
+        if self.hash_dim is not None:
+            self.buffer = [(cid, HASHED_KEY_NAME % h, value) for cid, h, value in self.buffer]
+        self.resolve_keys(frozenset(key_name for _, key_name, _ in self.buffer), key_group, replace_key_set,
+                          fingerprints)
+
+        # If AnnotationKey does not exist and create_new_keyset = False, skip; the last value of an Annotation wins
+        values = {}
+        for cid, key_name, value in self.buffer:
+            if key_name in self.key_cache:
+                values[(cid, self.key_cache[key_name])] = value
+        self.buffer = []
+        rows = [{'candidate_id': cid, 'key_id': key_id, 'value': value}
+                for (cid, key_id), value in values.iteritems() if value != 0]
+
+        # Zero values are not stored, but overwrite existing Annotations if clear=False
         if not clear:
-            anno_update_query = self.annotation_class.__table__.update()
-            anno_update_query = anno_update_query.where(self.annotation_class.candidate_id == bindparam('cid'))
-            anno_update_query = anno_update_query.where(self.annotation_class.key_id == bindparam('kid'))
-            anno_update_query = anno_update_query.values(value=bindparam('value'))
-        
-        # We only need to insert AnnotationKeys if replace_key_set=True
-        # Note that in current configuration, we never update AnnotationKeys!
-        if replace_key_set:
-            key_insert_query = self.annotation_key_class.__table__.insert()
-
-        # If we are replacing the AnnotationKeys (replace_key_set=True), then we assume they will
-        # all have been handled by *this* reduce thread, and hence be in the cache already
-        # So we only need key select queries if replace_key_set=False
+            zero_rows = [{'cid': cid, 'kid': key_id, 'value': 0} for (cid, key_id), value in values.iteritems()
+                         if value == 0]
+            if zero_rows:
+                anno_update_query = self.annotation_class.__table__.update()
+                anno_update_query = anno_update_query.where(self.annotation_class.candidate_id == bindparam('cid'))
+                anno_update_query = anno_update_query.where(self.annotation_class.key_id == bindparam('kid'))
+                anno_update_query = anno_update_query.values(value=bindparam('value'))
+                self.session.execute(anno_update_query, zero_rows)
+
+        # Insert with multi-row statements; if clear=False, existing Annotations are replaced (upserted)
+        anno_insert_query = self._anno_insert_query(clear)
+        batch_size        = rows_per_statement(len(self.annotation_class.__table__.columns))
+        for i in range(0, len(rows), batch_size):
+            self.session.execute(anno_insert_query.values(rows[i:i+batch_size]))
+
+    def _anno_insert_query(self, clear):
+        table = self.annotation_class.__table__
+        if clear:
+            return table.insert()
+        elif snorkel_postgres:
+            q = postgresql.insert(table)
+            return q.on_conflict_do_update(index_elements=[table.c.candidate_id, table.c.key_id],
+                                           set_={'value': q.excluded.value})
         else:
-            key_select_query = select([self.annotation_key_class.id])\
-                                .where(self.annotation_key_class.name == bindparam('name'))
-            if key_group is not None:
-                key_select_query = key_select_query.where(self.annotation_key_class.group == key_group)
-
-        anno_insert_query = self.annotation_class.__table__.insert()
-
-        # Check if the AnnotationKey already exists, and gets its id
-        key_id = None
-        if key_name in self.key_cache:
-            key_id = self.key_cache[key_name]
-        else:
-            key_args = {'name': key_name, 'group': key_group} if key_group else {'name': key_name}
-
-            # If we are replacing the AnnotationKeys (replace_key_set=True), then we assume they will
-            # all have been handled by *this* reduce thread, and hence be in the cache already
-            if not replace_key_set:
-                key_id = self.session.execute(key_select_query, key_args).first()
+            return table.insert().prefix_with('OR REPLACE')
 
-            # Key not in cache but exists in DB; add to cache
-            if key_id is not None:
-                key_id                   = key_id[0]
-                self.key_cache[key_name] = key_id
-
-            # Key not in cache or DB; add to both if create_new_keyset = True
-            elif replace_key_set:
-                key_id   = self.session.execute(key_insert_query, key_args).inserted_primary_key[0]
-                self.key_cache[key_name] = key_id
-
-        # If AnnotationKey does not exist and create_new_keyset = False, skip
-        if key_id is not None:
-
-            # Updates the Annotation, assuming one might already exist, if try_update = True
-            if not clear:
-                res = self.session.execute(anno_update_query, {'cid': cid, 'kid': key_id, 'value': value})
+    def resolve_keys(self, key_names, key_group, replace_key_set, fingerprints=None):
+        """
+        Adds the ids of the AnnotationKeys with key_names (in key_group, if not None) to the key cache, first
+        inserting any missing AnnotationKeys if replace_key_set=True
+        """
+        key_names = [key_name for key_name in key_names if key_name not in self.key_cache]
+        self._select_keys(key_names, key_group)
 
-            # If Annotation does not exist, insert
-            if (clear or res.rowcount == 0) and value != 0:
-                self.session.execute(anno_insert_query, {'candidate_id': cid, 'key_id': key_id, 'value': value})
+        # Key not in cache or DB; add to both if create_new_keyset = True
+        # Note that in current configuration, we never update AnnotationKeys!
+        key_names = [key_name for key_name in key_names if key_name not in self.key_cache]
+        if replace_key_set and key_names:
+            key_args = [{'name': key_name, 'group': key_group or 0} for key_name in key_names]
+            self.session.execute(self.annotation_key_class.__table__.insert(), key_args)
+            self._select_keys(key_names, key_group or 0)
+
+            # Store the fingerprints of the new LabelKeys, replacing any left over for their ids
+            if fingerprints is not None:
+                fp_args = [{'key_id': self.key_cache[key_name], 'fingerprint': fingerprints[key_name]}
+                           for key_name in key_names if fingerprints.get(key_name) is not None]
+                if fp_args:
+                    fp_table = LabelKeyFingerprint.__table__
+                    key_ids  = [args['key_id'] for args in fp_args]
+                    for i in range(0, len(key_ids), ID_BATCH_SIZE):
+                        q = fp_table.delete().where(fp_table.c.key_id.in_(key_ids[i:i+ID_BATCH_SIZE]))
+                        self.session.execute(q)
+                    self.session.execute(fp_table.insert(), fp_args)
+
+    def _select_keys(self, key_names, key_group):
+        for i in range(0, len(key_names), ID_BATCH_SIZE):
+            q = select([self.annotation_key_class.name, self.annotation_key_class.id])
+            q = q.where(self.annotation_key_class.name.in_(key_names[i:i+ID_BATCH_SIZE]))
+            if key_group is not None:
+                q = q.where(self.annotation_key_class.group == key_group)
+            self.key_cache.update(self.session.execute(q).fetchall())
 
 
-def load_matrix(matrix_class, annotation_key_class, annotation_class, session, split=0, key_group=0, key_names=None):
+def load_matrix(matrix_class, annotation_key_class, annotation_class, session, split=0, key_group=0, key_names=None,
+                batch_size=ANNOTATION_BATCH_SIZE, cache=False):
     """
     Returns the annotations corresponding to a split of candidates with N members
     and an AnnotationKey group with M distinct keys as an N x M CSR sparse matrix.
+
+    If cache=True, the matrix is also saved to a file in ANNOTATION_CACHE_DIR, and loaded from it instead of the DB
+    for as long as the AnnotationRun ids of the annotation and candidate tables are unchanged.
+    NOTE: Only the runs of UDFRunners renew these ids, so writes made outside of a UDFRunner (e.g. deleting Candidates
+    or annotations directly in a session) are not detected; pass cache=False, or call new_annotation_run, after them.
     """
+    path = None
+    if cache:
+        run_ids = get_annotation_runs(session, [annotation_class.__tablename__, Candidate.__tablename__])
+
+        # Tables not written by any run since AnnotationRuns were introduced cannot be checked, so are not cached
+        if None not in run_ids:
+            path = _matrix_cache_path(annotation_class, split, key_group, key_names)
+            if os.path.exists(path):
+                with np.load(path) as f:
+                    if tuple(f['run_ids'].tolist()) == run_ids:
+                        X = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+                        return _to_annotation_matrix(matrix_class, annotation_key_class, X, f['cids'], f['kids'])
+
     cid_query = session.query(Candidate.id)
     cid_query = cid_query.filter(Candidate.split == split)
     cid_query = cid_query.order_by(Candidate.id)
@@ -260,45 +429,63 @@ def load_matrix(matrix_class, annotation_key_class, annotation_class, session, s
         keys_query = keys_query.filter(annotation_key_class.name.in_(frozenset(key_names)))
     keys_query = keys_query.order_by(annotation_key_class.id)
 
-    # First, we query to construct the row index map
-    cid_to_row = {}
-    row_to_cid = {}
-    for cid, in cid_query.all():
-        if cid not in cid_to_row:
-            j = len(cid_to_row)
-
-            # Create both mappings
-            cid_to_row[cid] = j
-            row_to_cid[j]   = cid
-
-    # Second, we query to construct the column index map
-    kid_to_col = {}
-    col_to_kid = {}
-    for kid, in keys_query.all():
-        if kid not in kid_to_col:
-            j = len(kid_to_col)
-
-            # Create both mappings
-            kid_to_col[kid] = j
-            col_to_kid[j]   = kid
-
-    # Create sparse matrix in LIL format for incremental construction
-    X = sparse.lil_matrix((len(cid_to_row), len(kid_to_col)))
-
-    # NOTE: This is much faster as it allows us to skip the above join (which for some reason is
-    # unreasonably slow) by relying on our symbol tables from above; however this will get slower with
-    # The total number of annotations in DB which is weird behavior...
-    q = session.query(annotation_class.candidate_id, annotation_class.key_id, annotation_class.value)
-    q = q.order_by(annotation_class.candidate_id)
-    
-    # Iteratively construct row index and output sparse matrix
-    for cid, kid, val in q.all():
-        if cid in cid_to_row and kid in kid_to_col:
-            X[cid_to_row[cid], kid_to_col[kid]] = val
+    # Sorted id arrays define the row and column index maps; ids are mapped to positions by binary search
+    cids = np.array([cid for cid, in cid_query.all()], dtype=np.int64)
+    kids = np.array([kid for kid, in keys_query.all()], dtype=np.int64)
 
-    # Return as an AnnotationMatrix
-    return matrix_class(X, candidate_index=cid_to_row, row_index=row_to_cid,
-                        annotation_key_cls=annotation_key_class, key_index=kid_to_col, col_index=col_to_kid)
+    # The split and key group filters are applied in the DB, so only annotations in the output matrix are read
+    q = select([annotation_class.candidate_id, annotation_class.key_id, annotation_class.value])
+    q = q.where(annotation_class.candidate_id == Candidate.id).where(Candidate.split == split)
+    q = q.where(annotation_class.key_id == annotation_key_class.id)
+    q = q.where(annotation_key_class.group == key_group)
+    if key_names is not None:
+        q = q.where(annotation_key_class.name.in_(frozenset(key_names)))
+
+    # Stream the annotations in chunks (through a server-side cursor where supported), converting each to arrays
+    rows, cols, vals = [], [], []
+    res = session.execute(q.execution_options(stream_results=True))
+    while True:
+        chunk = res.fetchmany(batch_size)
+        if not chunk:
+            break
+        cid, kid, val = zip(*chunk)
+        rows.append(np.searchsorted(cids, np.array(cid, dtype=np.int64)))
+        cols.append(np.searchsorted(kids, np.array(kid, dtype=np.int64)))
+        vals.append(np.array(val, dtype=np.float64))
+    res.close()
+
+    # Build the CSR matrix directly from COO arrays
+    shape = (len(cids), len(kids))
+    if vals:
+        X = sparse.coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=shape)
+    else:
+        X = sparse.coo_matrix(shape)
+    X = X.tocsr()
+
+    # Save to the cache, via a temporary file so that concurrent loads never read a partial file
+    if path is not None:
+        if not os.path.exists(ANNOTATION_CACHE_DIR):
+            os.makedirs(ANNOTATION_CACHE_DIR)
+        tmp_path = '%s.%s.tmp.npz' % (path[:-4], os.getpid())
+        np.savez(tmp_path, data=X.data, indices=X.indices, indptr=X.indptr, shape=np.array(X.shape),
+                 cids=cids, kids=kids, run_ids=np.array(run_ids))
+        os.rename(tmp_path, path)
+    return _to_annotation_matrix(matrix_class, annotation_key_class, X, cids, kids)
+
+
+def _matrix_cache_path(annotation_class, split, key_group, key_names):
+    """Returns the path of the cache file of an annotation matrix, specific to the DB and the matrix arguments"""
+    names = None if key_names is None else sorted(frozenset(key_names))
+    h     = sha1(repr((snorkel_conn_string, split, key_group, names))).hexdigest()
+    return os.path.join(ANNOTATION_CACHE_DIR, '%s_%s.npz' % (annotation_class.__tablename__, h))
+
+
+def _to_annotation_matrix(matrix_class, annotation_key_class, X, cids, kids):
+    """Returns CSR matrix X as an AnnotationMatrix, with rows and columns indexed by the arrays of ids (or names)"""
+    cids, kids = cids.tolist(), kids.tolist()
+    return matrix_class(X, candidate_index=dict(zip(cids, xrange(len(cids)))), row_index=dict(enumerate(cids)),
+                        annotation_key_cls=annotation_key_class, key_index=dict(zip(kids, xrange(len(kids)))),
+                        col_index=dict(enumerate(kids)))
 
 
 def load_label_matrix(session, **kwargs):
@@ -316,32 +503,379 @@ def load_gold_labels(session, annotator_name, **kwargs):
 class LabelAnnotator(Annotator):
     """Apply labeling functions to the candidates, generating Label annotations"""
     def __init__(self, f):
+        self.lfs = f if hasattr(f, '__iter__') else None
         super(LabelAnnotator, self).__init__(Label, LabelKey, f)
 
+    def apply(self, split, key_group=0, replace_key_set=True, incremental=False, **kwargs):
+        """
+        Applies the labeling functions to the candidates in split, storing the fingerprint of each labeling function
+        (see lf_fingerprint) as the LabelKeyFingerprint of its LabelKey.
+
+        If incremental=True, only the labeling functions which are new or whose fingerprint has changed are applied,
+        and the LabelKeys (with their Labels) of changed and removed labeling functions are deleted; the Labels of
+        the other labeling functions are kept (also if clear=False). Note that the Labels of new and changed labeling
+        functions are then only created for this split, so other splits should be relabeled with apply_existing.
+        """
+        fingerprints = None if self.lfs is None else dict((f.__name__, lf_fingerprint(f)) for f in self.lfs)
+        if incremental:
+            if fingerprints is None:
+                raise ValueError("Incremental labeling requires a list of labeling functions.")
+            if not replace_key_set:
+                raise ValueError("Incremental labeling requires replace_key_set=True.")
+            SnorkelSession = new_sessionmaker()
+            session        = SnorkelSession()
+            key_query      = session.query(LabelKey.name, LabelKeyFingerprint.fingerprint)\
+                                .outerjoin(LabelKeyFingerprint, LabelKeyFingerprint.key_id == LabelKey.id)\
+                                .filter(LabelKey.group == key_group)
+            key_fps        = dict(key_query.all())
+
+            # Labeling functions which cannot be fingerprinted are always rerun
+            lf_names = frozenset(name for name, fp in fingerprints.iteritems() if fp is None or key_fps.get(name) != fp)
+
+            # The keys of changed and removed labeling functions are deleted whether or not clear=True, so that
+            # they are recreated, with their new fingerprints, by this run
+            self.delete_keys(session, key_group, lf_names.union(frozenset(key_fps).difference(fingerprints)))
+            session.commit()
+            session.close()
+            kwargs['lf_names'] = lf_names
+        return super(LabelAnnotator, self).apply(split, key_group=key_group, replace_key_set=replace_key_set,
+                                                 fingerprints=fingerprints, **kwargs)
+
+    def clear(self, session, split, key_group, replace_key_set, lf_names=None, **kwargs):
+        """
+        For an incremental run (lf_names is not None), the keys of changed and removed labeling functions have
+        already been deleted by apply, and all other Labels are kept; else see Annotator.clear
+        """
+        if lf_names is None:
+            return super(LabelAnnotator, self).clear(session, split, key_group, replace_key_set, **kwargs)
+
+    def delete_keys(self, session, key_group, key_names):
+        """Deletes the LabelKeys in key_group with key_names, with their Labels and fingerprints"""
+        key_names = list(key_names)
+        key_ids   = []
+        for i in range(0, len(key_names), ID_BATCH_SIZE):
+            key_query = session.query(LabelKey.id).filter(LabelKey.group == key_group)
+            key_ids.extend(key_id for key_id, in key_query.filter(LabelKey.name.in_(key_names[i:i+ID_BATCH_SIZE])))
+        for i in range(0, len(key_ids), ID_BATCH_SIZE):
+            ids = key_ids[i:i+ID_BATCH_SIZE]
+            session.query(Label).filter(Label.key_id.in_(ids)).delete(synchronize_session='fetch')
+            session.query(LabelKeyFingerprint).filter(LabelKeyFingerprint.key_id.in_(ids))\
+                .delete(synchronize_session='fetch')
+            session.query(LabelKey).filter(LabelKey.id.in_(ids)).delete(synchronize_session='fetch')
+
     def load_matrix(self, session, split, **kwargs):
         return load_label_matrix(session, split=split, **kwargs)
 
         
 class FeatureAnnotator(Annotator):
-    """Apply feature generators to the candidates, generating Feature annotations"""
-    def __init__(self, f=get_span_feats):
-        super(FeatureAnnotator, self).__init__(Feature, FeatureKey, f)
+    """
+    Apply feature generators to the candidates, generating Feature annotations
+
+    If hash_dim is given, feature names are hashed to hash_dim columns in the UDF(s) (see hash_key_name), the values
+    of colliding features being summed; so at most hash_dim FeatureKeys, named HASHED_KEY_NAME % h, are created.
+    """
+    def __init__(self, f=get_span_feats, hash_dim=None):
+        self.f        = f
+        self.hash_dim = hash_dim
+        super(FeatureAnnotator, self).__init__(Feature, FeatureKey, f, hash_dim=hash_dim)
+
+    def get_hashed_names(self, session, split=0, n=100):
+        """
+        Returns a reverse dictionary of a hashed feature space, sampled from n random Candidates of split: maps each
+        hashed FeatureKey name to the set of feature names hashed to it.
+        """
+        if self.hash_dim is None:
+            raise ValueError("Feature names are only hashed if hash_dim is given.")
+        anno_generator = _to_annotation_generator(self.f) if hasattr(self.f, '__iter__') else self.f
+        names          = defaultdict(set)
+        for c in session.query(Candidate).filter(Candidate.split == split).order_by(func.random()).limit(n):
+            for key_name, _ in anno_generator(c):
+                names[HASHED_KEY_NAME % hash_key_name(key_name, self.hash_dim)].add(key_name)
+        return dict(names)
 
     def load_matrix(self, session, split, key_group=0, **kwargs):
         return load_feature_matrix(session, split=split, key_group=key_group, **kwargs)
 
 
+class FeatureMatrixBuilder(UDFRunner):
+    """
+    Featurizes the candidates straight into a sparse matrix, without storing Features in the DB: the UDF(s) build a
+    CSR block, with its own vocabulary of feature names, for each batch of candidates, and these are merged here.
+    """
+    def __init__(self, f=get_span_feats):
+        self.blocks = []
+        super(FeatureMatrixBuilder, self).__init__(FeatureMatrixUDF, f=f, blocks=self.blocks)
+
+    def apply(self, split, key_names=None, path=None, batch_size=ID_BATCH_SIZE, **kwargs):
+        """
+        Returns the features of the candidates in split as a csr_AnnotationMatrix, with rows ordered by candidate id,
+        and columns indexed by feature name (i.e. key_index and col_index hold names instead of FeatureKey ids).
+
+        If key_names is given, e.g. the names of the columns of a training matrix, the columns are these features,
+        others being dropped; else all the features are included, in order of first occurrence.
+        If path is given, the matrix is also saved to it, see load_feature_matrix_file.
+        """
+        del self.blocks[:]
+        SnorkelSession = new_sessionmaker()
+        session        = SnorkelSession()
+        cids_query     = session.query(Candidate.id).filter(Candidate.split == split).order_by(Candidate.id)
+        cids           = [cid for cid, in cids_query.all()]
+        session.close()
+        batches = [CandidateIdBatch(cids[i:i+batch_size]) for i in range(0, len(cids), batch_size)]
+        super(FeatureMatrixBuilder, self).apply(batches, clear=False, count=len(batches), **kwargs)
+        F = _merge_feature_blocks(self.blocks, key_names)
+        del self.blocks[:]
+        if path is not None:
+            save_feature_matrix_file(path, F)
+        return F
+
+
+class FeatureMatrixUDF(AnnotatorUDF):
+    def __init__(self, f, blocks, **kwargs):
+        self.blocks = blocks
+        super(FeatureMatrixUDF, self).__init__(Feature, FeatureKey, f, **kwargs)
+
+    def apply(self, candidates, **kwargs):
+        """Yields the features of a batch of Candidates as a cids, feature names, CSR matrix block"""
+        row_index = dict((c.id, i) for i, c in enumerate(candidates))
+        vocab     = {}
+        rows, cols, vals = [], [], []
+        for cid, key_name, value in self._annotate(candidates, None):
+            j = vocab.setdefault(key_name, len(vocab))
+            if value != 0:
+                rows.append(row_index[cid])
+                cols.append(j)
+                vals.append(value)
+        X = sparse.csr_matrix((np.array(vals, dtype=np.float64), (rows, cols)), shape=(len(candidates), len(vocab)))
+        yield [c.id for c in candidates], sorted(vocab, key=vocab.get), X
+
+    def reduce(self, y, **kwargs):
+        """Collects the blocks, in the list shared with the FeatureMatrixBuilder"""
+        self.blocks.append(y)
+
+    def flush(self, **kwargs):
+        pass
+
+
+def _merge_feature_blocks(blocks, key_names=None):
+    """
+    Merges the cids, feature names, CSR matrix blocks of FeatureMatrixUDFs in candidate id order into one
+    csr_AnnotationMatrix, mapping their local vocabularies to the global one (see FeatureMatrixBuilder.apply)
+    """
+    vocab = {} if key_names is None else dict((name, j) for j, name in enumerate(key_names))
+    rows, cols, vals, cids = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)], []
+    for block_cids, names, X in sorted(blocks, key=lambda block: block[0][0]):
+        if key_names is None:
+            col_map = np.array([vocab.setdefault(name, len(vocab)) for name in names], dtype=np.int64)
+        else:
+            col_map = np.array([vocab.get(name, -1) for name in names], dtype=np.int64)
+        X    = X.tocoo()
+        col  = col_map[X.col]
+        keep = col >= 0
+        rows.append(X.row[keep] + len(cids))
+        cols.append(col[keep])
+        vals.append(X.data[keep])
+        cids.extend(block_cids)
+    X = sparse.coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                          shape=(len(cids), len(vocab))).tocsr()
+    return _to_annotation_matrix(csr_AnnotationMatrix, None, X, np.array(cids, dtype=np.int64),
+                                 np.array(sorted(vocab, key=vocab.get)))
+
+
+def save_feature_matrix_file(path, F):
+    """Saves a feature matrix built by FeatureMatrixBuilder to path, as an .npz file"""
+    np.savez(path, data=F.data, indices=F.indices, indptr=F.indptr, shape=np.array(F.shape),
+             cids=np.array([F.row_index[i] for i in range(F.shape[0])], dtype=np.int64),
+             names=np.array([F.col_index[j] for j in range(F.shape[1])]))
+
+
+def load_feature_matrix_file(path):
+    """Loads a feature matrix saved by save_feature_matrix_file"""
+    with np.load(path) as f:
+        X = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+        return _to_annotation_matrix(csr_AnnotationMatrix, None, X, f['cids'], f['names'])
+
+
 def _to_annotation_generator(fns):
     """"
     Generic method which takes a set of functions, and returns a generator that yields
-    function.__name__, function result pairs.
+    function.__name__, function result pairs; optionally only for the functions with the given names.
     """
-    def fn_gen(c):
+    def fn_gen(c, names=None):
         for f in fns:
-            yield f.__name__, f(c)
+            if names is None or f.__name__ in names:
+                yield f.__name__, f(c)
     return fn_gen
 
 
+def hash_key_name(key_name, hash_dim):
+    """Returns the hash of a key name as an integer in [0, hash_dim), stable across processes and runs"""
+    if isinstance(key_name, unicode):
+        key_name = key_name.encode('utf-8')
+    return (zlib.crc32(key_name) & 0xffffffff) % hash_dim
+
+
+def _hash_annotations(annotations, hash_dim):
+    """Sums the values of cid, key_name, value triples by cid and hashed key name"""
+    values = defaultdict(float)
+    for cid, key_name, value in annotations:
+        values[(cid, hash_key_name(key_name, hash_dim))] += value
+    for (cid, h), value in values.iteritems():
+        yield cid, h, value
+
+
+def batch_lf(f):
+    """
+    Decorator marking a labeling (or other annotation) function as a batch function: instead of each Candidate, it
+    is given a CandidateBatch, and returns a sequence (e.g. a NumPy array) with one value per Candidate of the batch.
+    """
+    f.batch = True
+    return f
+
+
+class CandidateBatch(object):
+    """
+    A batch of Candidates, as given to batch functions (see batch_lf). Columns of per-Candidate values,
+    e.g. batch.column(get_between_tokens), are computed once per batch and shared by all the batch functions.
+    """
+    def __init__(self, candidates):
+        self.candidates = candidates
+        self.ids        = np.array([c.id for c in candidates], dtype=np.int64)
+        self.columns    = {}
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def __iter__(self):
+        return iter(self.candidates)
+
+    def __getitem__(self, i):
+        return self.candidates[i]
+
+    def column(self, f, *args, **kwargs):
+        """Returns the list of values f(c, *args, **kwargs) of the Candidates; the arguments must be hashable"""
+        key = (f, args, tuple(sorted(kwargs.iteritems())))
+        if key not in self.columns:
+            self.columns[key] = [f(c, *args, **kwargs) for c in self.candidates]
+        return self.columns[key]
+
+    def search(self, f, pattern, flags=0):
+        """Returns a boolean array of whether the regex pattern is found in each string of column f"""
+        rgx = re.compile(pattern, flags)
+        return np.array([rgx.search(x) is not None for x in self.column(f)], dtype=bool)
+
+    def contains(self, f, tokens):
+        """Returns a boolean array of whether each sequence of column f (e.g. of tokens) contains any of tokens"""
+        tokens = frozenset(tokens)
+        return np.array([not tokens.isdisjoint(x) for x in self.column(f)], dtype=bool)
+
+
+# Types of referenced values which are hashed by value in fingerprints
+FINGERPRINT_VALUE_TYPES = (basestring, int, long, float, bool, type(None))
+FINGERPRINT_CONTAINER_TYPES = (tuple, list, set, frozenset, dict)
+REGEX_TYPE = type(re.compile(''))
+
+
+def lf_fingerprint(f):
+    """
+    Returns a fingerprint of the definition of labeling function f: a hash of its bytecode and constants, default
+    arguments, closure and the global values it references, recursing into referenced functions. Partials, methods
+    and callable objects are fingerprinted by their underlying function and their arguments or instance attributes.
+    Changes to other referenced objects, e.g. instances of classes or modules, are not detected.
+
+    Returns None if f is not based on a Python function, e.g. if it is a builtin; such a labeling function is then
+    always considered changed.
+    """
+    if _get_function(f) is None:
+        return None
+    h = sha1()
+    _update_fingerprint(h, f, set())
+    return h.hexdigest()
+
+
+def _get_function(f):
+    """Returns the Python function underlying callable f, or None"""
+    if isinstance(f, FunctionType):
+        return f
+    elif isinstance(f, partial):
+        return _get_function(f.func)
+    elif isinstance(f, MethodType):
+        return _get_function(f.__func__)
+    elif _is_callable_object(f):
+        return _get_function(type(f).__call__)
+    return None
+
+
+def _is_callable_object(x):
+    return not isinstance(x, type) and isinstance(getattr(type(x), '__call__', None), MethodType)
+
+
+def _code_names(code):
+    """Yields the global (and attribute) names used in code, including in nested functions"""
+    for name in code.co_names:
+        yield name
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            for name in _code_names(const):
+                yield name
+
+
+def _update_fingerprint(h, x, seen):
+    if isinstance(x, FunctionType):
+        if id(x) in seen:
+            h.update(repr(x.__name__))
+            return
+        seen.add(id(x))
+        h.update(repr(x.__name__))
+        _update_fingerprint(h, x.__code__, seen)
+        _update_fingerprint(h, x.__defaults__, seen)
+        _update_fingerprint(h, tuple(cell.cell_contents for cell in x.__closure__ or ()), seen)
+        for name in sorted(frozenset(_code_names(x.__code__))):
+            v = x.__globals__.get(name)
+            if isinstance(v, FINGERPRINT_VALUE_TYPES + FINGERPRINT_CONTAINER_TYPES + (FunctionType, REGEX_TYPE)):
+                h.update(repr(name))
+                _update_fingerprint(h, v, seen)
+    elif isinstance(x, partial):
+        h.update('partial')
+        _update_fingerprint(h, x.func, seen)
+        _update_fingerprint(h, x.args, seen)
+        _update_fingerprint(h, x.keywords or {}, seen)
+    elif isinstance(x, MethodType):
+        h.update('method')
+        _update_fingerprint(h, x.__func__, seen)
+        if x.__self__ is not None:
+            _update_fingerprint(h, getattr(x.__self__, '__dict__', {}), seen)
+    elif _is_callable_object(x):
+        h.update(type(x).__name__)
+        if id(x) not in seen:
+            seen.add(id(x))
+            _update_fingerprint(h, type(x).__call__, seen)
+            _update_fingerprint(h, getattr(x, '__dict__', {}), seen)
+    elif isinstance(x, CodeType):
+        h.update(x.co_code)
+        h.update(repr(x.co_names))
+        _update_fingerprint(h, x.co_consts, seen)
+    elif isinstance(x, REGEX_TYPE):
+        h.update(repr((x.pattern, x.flags)))
+    elif isinstance(x, dict):
+        h.update('dict' + str(len(x)))
+        for k in sorted(x, key=repr):
+            _update_fingerprint(h, k, seen)
+            _update_fingerprint(h, x[k], seen)
+    elif isinstance(x, (set, frozenset)):
+        h.update('set' + str(len(x)))
+        for v in sorted(x, key=repr):
+            _update_fingerprint(h, v, seen)
+    elif isinstance(x, (tuple, list)):
+        h.update(type(x).__name__ + str(len(x)))
+        for v in x:
+            _update_fingerprint(h, v, seen)
+    elif isinstance(x, FINGERPRINT_VALUE_TYPES):
+        h.update(repr(x))
+    else:
+        h.update(type(x).__name__)
+
+
 def save_marginals(session, L, marginals):
     """Save the marginal probs. for the Candidates corresponding to the rows of L in the Candidate table."""
     # Prepare bulk UPDATE query
@@ -349,8 +883,9 @@ def save_marginals(session, L, marginals):
             where(Candidate.id == bindparam('cid')).\
             values(training_marginal=bindparam('tm'))
 
-    # Prepare values
-    update_vals = [{'cid': L.get_candidate(session, i).id, 'tm': marginals[i]} for i in range(len(marginals))]
+    # Prepare values, taking the Candidate ids from the row index of L
+    marginals   = np.ravel(marginals).tolist()
+    update_vals = [{'cid': L.row_index[i], 'tm': tm} for i, tm in enumerate(marginals)]
 
     # Execute update
     session.execute(q, update_vals)
@@ -358,6 +893,22 @@ def save_marginals(session, L, marginals):
     print "Saved %s training marginals" % len(marginals)
 
 
-def load_marginals(session, split):
-    """Load the marginal probs. for a given split of Candidates"""
-    return np.array([c[0] for c in session.query(Candidate.training_marginal).filter(Candidate.split == split).all()])
+def load_marginals(session, split=0, L=None):
+    """
+    Load the marginal probs. for a given split of Candidates, ordered by Candidate id--i.e. aligned with the rows
+    of its annotation matrices--or, if L is given, aligned with the rows of L. Missing marginals are NaN.
+    """
+    if L is None:
+        q = session.query(Candidate.training_marginal).filter(Candidate.split == split).order_by(Candidate.id)
+        return np.array([tm for tm, in q.yield_per(ANNOTATION_BATCH_SIZE)], dtype=np.float64)
+
+    # Load the marginals of the Candidates of L's rows with one query per ID_BATCH_SIZE ids
+    marginals = np.empty(L.shape[0])
+    marginals.fill(np.nan)
+    cids = [L.row_index[i] for i in range(L.shape[0])]
+    for i in range(0, len(cids), ID_BATCH_SIZE):
+        q = session.query(Candidate.id, Candidate.training_marginal).filter(Candidate.id.in_(cids[i:i+ID_BATCH_SIZE]))
+        for cid, tm in q.all():
+            if tm is not None:
+                marginals[L.candidate_index[cid]] = tm
+    return marginals
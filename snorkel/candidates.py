@@ -1,16 +1,47 @@
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
 from copy import deepcopy
-from itertools import product
+from itertools import chain, product
+import numpy as np
 import re
 from sqlalchemy.sql import select
 
-from .models import Candidate, TemporarySpan, Sentence
+from .matchers import DictionaryTrie, EntityMatcher, NgramMatcher, PURE_MATCHERS
+from .models import Candidate, ContextIdIndex, Document, TemporarySpan, Sentence, SpanBatch
+from .models import build_context_bloom_filter, get_token_offsets, load_ids_or_insert
+from .models.meta import new_sessionmaker, rows_per_statement
 from .udf import UDF, UDFRunner
 
 QUEUE_COLLECT_TIMEOUT = 5
 
+# Max. number of ids per IN clause when loading existing candidates
+EXISTENCE_CHECK_BATCH_SIZE = rows_per_statement(1)
 
-class CandidateExtractor(UDFRunner):
+
+class SpanExtractor(UDFRunner):
+    """
+    UDFRunner for extractors whose UDFs materialize Spans through a ContextIdIndex. If bloom_filter is True, a Bloom
+    filter over the existing Context stable_ids is built once per run, before starting the UDF(s), and handed to them.
+    """
+    output_table = Candidate.__tablename__
+
+    def __init__(self, udf_class, bloom_filter=False, **udf_init_kwargs):
+        super(SpanExtractor, self).__init__(udf_class, **udf_init_kwargs)
+        self.bloom_filter = bloom_filter
+
+    def apply(self, xs, **kwargs):
+        if self.bloom_filter:
+            SnorkelSession = new_sessionmaker()
+            session = SnorkelSession()
+            self.udf_init_kwargs['bloom'] = build_context_bloom_filter(session)
+            session.close()
+        try:
+            super(SpanExtractor, self).apply(xs, **kwargs)
+        finally:
+            self.udf_init_kwargs.pop('bloom', None)
+
+
+class CandidateExtractor(SpanExtractor):
     """
     An operator to extract Candidate objects from a Context.
 
@@ -26,15 +57,29 @@ class CandidateExtractor(UDFRunner):
                              that contains it. Only applies to binary relations. Default is False.
     :param symmetric_relations: Boolean indicating whether to extract symmetric Candidates, i.e., rel(A,B) and rel(B,A),
                                 where A and B are Contexts. Only applies to binary relations. Default is True.
+    :param bloom_filter: Boolean indicating whether to build a Bloom filter over the existing Context stable_ids, so that
+                         Spans which are certainly new are inserted without any lookup. It is built once per run, and
+                         shared by the UDF(s). Default is False.
+    :param max_token_distance: If provided, only extract binary Candidates whose arguments are separated by at most this
+                               many tokens. Default is None (no limit).
+    :param max_pairs_per_context: If provided, extract at most this many Candidates from each Context, in order of the
+                                  first argument's position. Default is None (no limit).
+
+    Contexts can also be given by id, e.g. as ranges of Sentence ids, with apply_ids(Sentence, ids, split=split); they
+    are then loaded in batches by the UDF(s) themselves.
     """
-    def __init__(self, candidate_class, cspaces, matchers, self_relations=False, nested_relations=False, symmetric_relations=True):
+    def __init__(self, candidate_class, cspaces, matchers, self_relations=False, nested_relations=False, symmetric_relations=True,
+                 bloom_filter=False, max_token_distance=None, max_pairs_per_context=None):
         super(CandidateExtractor, self).__init__(CandidateExtractorUDF,
                                                  candidate_class=candidate_class,
                                                  cspaces=cspaces,
                                                  matchers=matchers,
                                                  self_relations=self_relations,
                                                  nested_relations=nested_relations,
-                                                 symmetric_relations=symmetric_relations)
+                                                 symmetric_relations=symmetric_relations,
+                                                 bloom_filter=bloom_filter,
+                                                 max_token_distance=max_token_distance,
+                                                 max_pairs_per_context=max_pairs_per_context)
 
     def apply(self, xs, split=0, **kwargs):
         super(CandidateExtractor, self).apply(xs, split=split, **kwargs)
@@ -44,13 +89,19 @@ class CandidateExtractor(UDFRunner):
 
 
 class CandidateExtractorUDF(UDF):
-    def __init__(self, candidate_class, cspaces, matchers, self_relations, nested_relations, symmetric_relations, **kwargs):
-        self.candidate_class     = candidate_class
-        self.candidate_spaces    = cspaces if type(cspaces) in [list, tuple] else [cspaces]
-        self.matchers            = matchers if type(matchers) in [list, tuple] else [matchers]
-        self.nested_relations    = nested_relations
-        self.self_relations      = self_relations
-        self.symmetric_relations = symmetric_relations
+    def __init__(self, candidate_class, cspaces, matchers, self_relations, nested_relations, symmetric_relations,
+                 bloom=None, max_token_distance=None, max_pairs_per_context=None, **kwargs):
+        self.candidate_class       = candidate_class
+        self.candidate_spaces      = cspaces if type(cspaces) in [list, tuple] else [cspaces]
+        self.matchers              = matchers if type(matchers) in [list, tuple] else [matchers]
+        self.nested_relations      = nested_relations
+        self.self_relations        = self_relations
+        self.symmetric_relations   = symmetric_relations
+        self.max_token_distance    = max_token_distance
+        self.max_pairs_per_context = max_pairs_per_context
+
+        # In-memory index of the existing Spans of the current Document, used when materializing Spans
+        self.context_id_index      = ContextIdIndex(bloom=bloom)
 
         # Check that arity is same
         if len(self.candidate_spaces) != len(self.matchers):
@@ -58,8 +109,21 @@ class CandidateExtractorUDF(UDF):
         else:
             self.arity = len(self.candidate_spaces)
 
-        # Make sure the candidate spaces are different so generators aren't expended!
-        self.candidate_spaces = map(deepcopy, self.candidate_spaces)
+        # Arguments with equivalent candidate spaces share a single enumeration of each context, fanned out to their
+        # matchers; make sure the candidate spaces of different groups are different so generators aren't expended!
+        self.cspace_groups = []
+        for i, cspace in enumerate(self.candidate_spaces):
+            for group_cspace, idxs in self.cspace_groups:
+                if equivalent_candidate_spaces(cspace, group_cspace):
+                    idxs.append(i)
+                    break
+            else:
+                self.cspace_groups.append((cspace, [i]))
+        self.cspace_groups    = [(deepcopy(cspace), idxs) for cspace, idxs in self.cspace_groups]
+        self.candidate_spaces = [None] * self.arity
+        for cspace, idxs in self.cspace_groups:
+            for i in idxs:
+                self.candidate_spaces[i] = cspace
 
         # Preallocates internal data structures
         self.child_context_sets = [None] * self.arity
@@ -71,46 +135,156 @@ class CandidateExtractorUDF(UDF):
     def apply(self, context, clear, split, **kwargs):
         # Generate TemporaryContexts that are children of the context using the candidate_space and filtered
         # by the Matcher
-        for i in range(self.arity):
-            self.child_context_sets[i].clear()
-            for tc in self.matchers[i].apply(self.candidate_spaces[i].apply(context)):
-                tc.load_id_or_insert(self.session)
-                self.child_context_sets[i].add(tc)
+        for cspace, idxs in self.cspace_groups:
+            matches = self._match(cspace, [self.matchers[i] for i in idxs], context)
+            for i, tcs in zip(idxs, matches):
+                self.child_context_sets[i].clear()
+                self.child_context_sets[i].update(tcs)
+
+        # Materialize the matched TemporaryContexts of all arguments in bulk
+        self.context_id_index.set_document(getattr(context, 'document_id', None))
+        load_ids_or_insert(self.session, chain.from_iterable(self.child_context_sets), index=self.context_id_index)
+
+        # Load the argument ids of the existing candidates of this context once, for checking existence
+        if not clear:
+            existing_args = load_existing_candidate_args(self.session, self.candidate_class,
+                                                         [tc.id for tc in self.child_context_sets[0]])
 
         # Generates and persists candidates
+        # TODO: Make the pruning work for higher-order relations
+        child_contexts = [sorted(child_context_set, key=span_position) for child_context_set in self.child_context_sets]
+        if self.arity == 2:
+            arg_tuples = span_pairs(child_contexts[0], child_contexts[1], self_relations=self.self_relations,
+                                    nested_relations=self.nested_relations, symmetric_relations=self.symmetric_relations,
+                                    max_token_distance=self.max_token_distance)
+        else:
+            arg_tuples = product(*child_contexts)
         candidate_args = {'split': split}
-        for args in product(*[enumerate(child_contexts) for child_contexts in self.child_context_sets]):
+        for n, args in enumerate(arg_tuples):
+            if self.max_pairs_per_context is not None and n >= self.max_pairs_per_context:
+                break
 
-            # TODO: Make this work for higher-order relations
-            if self.arity == 2:
-                ai, a = args[0]
-                bi, b = args[1]
-
-                # Check for self-joins, "nested" joins (joins from span to its subspan), and flipped duplicate
-                # "symmetric" relations
-                if not self.self_relations and a == b:
-                    continue
-                elif not self.nested_relations and (a in b or b in a):
-                    continue
-                elif not self.symmetric_relations and ai > bi:
-                    continue
+            # Checking for existence
+            if not clear and tuple(arg.id for arg in args) in existing_args:
+                continue
 
             # Assemble candidate arguments
             for i, arg_name in enumerate(self.candidate_class.__argnames__):
-                candidate_args[arg_name + '_id'] = args[i][1].id
-
-            # Checking for existence
-            if not clear:
-                q = select([self.candidate_class.id])
-                for key, value in candidate_args.items():
-                    q = q.where(getattr(self.candidate_class, key) == value)
-                candidate_id = self.session.execute(q).first()
-                if candidate_id is not None:
-                    continue
+                candidate_args[arg_name + '_id'] = args[i].id
 
             # Add Candidate to session
             yield self.candidate_class(**candidate_args)
 
+    def _match(self, candidate_space, matchers, context):
+        """
+        Enumerates the candidate space of context once, and returns the TemporaryContexts accepted by each of the
+        matchers, as a list of lists; the same matcher is applied only once.
+        """
+        # Entity type matchers over all n-grams directly generate their longest matches from the NER segments
+        segment_matchers = set(id(matcher) for matcher in matchers if uses_segments(candidate_space, matcher, context))
+
+        # For n-grams, the Matchers are applied to the offset arrays directly, so that only matches become
+        # TemporarySpans
+        if isinstance(candidate_space, Ngrams):
+            if any(id(matcher) not in segment_matchers for matcher in matchers):
+                char_starts, char_ends = candidate_space.get_offsets(context)
+                enumerate_space        = lambda : iter(SpanBatch(context, char_starts, char_ends))
+        elif len(set(map(id, matchers))) > 1:
+            tcs             = list(candidate_space.apply(context))
+            enumerate_space = lambda : iter(tcs)
+        else:
+            enumerate_space = lambda : candidate_space.apply(context)
+
+        matches = {}
+        for matcher in matchers:
+            if id(matcher) not in matches:
+                if id(matcher) in segment_matchers:
+                    matches[id(matcher)] = list(matcher.get_segments(context, n_max=candidate_space.n_max))
+                elif isinstance(candidate_space, Ngrams) and isinstance(matcher, NgramMatcher):
+                    matches[id(matcher)] = list(matcher.apply_ngrams(context, char_starts, char_ends))
+                else:
+                    matches[id(matcher)] = list(matcher.apply(enumerate_space()))
+        return [matches[id(matcher)] for matcher in matchers]
+
+
+def uses_segments(candidate_space, matcher, context):
+    """
+    Tests if the matches of matcher among the candidate_space of context are generated by EntityMatcher.get_segments,
+    i.e. for a built-in EntityMatcher with longest_match_only over all the n-grams of a Sentence with increasing
+    offsets
+    """
+    if type(candidate_space) is not Ngrams or type(matcher) not in PURE_MATCHERS:
+        return False
+    if not isinstance(matcher, EntityMatcher) or not matcher.longest_match_only or len(matcher.children) > 0:
+        return False
+    offsets, _ = get_token_offsets(context)
+    return bool(np.all(offsets[1:] > offsets[:-1]))
+
+
+def equivalent_candidate_spaces(a, b):
+    """Tests if candidate spaces a and b enumerate the same TemporaryContexts of any context"""
+    return a is b or (type(a) is type(b) and a.__dict__ == b.__dict__)
+
+
+def span_position(span):
+    """Sort key ordering the Spans of a Context by position"""
+    return span.char_start, span.char_end
+
+
+def span_pairs(a_spans, b_spans, self_relations=False, nested_relations=False, symmetric_relations=True,
+               max_token_distance=None):
+    """
+    Generates the valid (a, b) argument pairs of a binary relation, given lists a_spans and b_spans of Spans in the
+    same Context, each sorted by span_position. See CandidateExtractor for the semantics of the options.
+
+    Rather than filtering the full cross product, only the valid range of b_spans is visited for each a: if
+    symmetric_relations=False, the pairs (a_spans[i], b_spans[j]) with j >= i; if max_token_distance is provided,
+    the b_spans starting within reach of a, found by bisecting the (sorted) b_spans word starts.
+    """
+    if max_token_distance is not None:
+        b_starts  = [b.get_word_start() for b in b_spans]
+        b_ends    = [b.get_word_end() for b in b_spans]
+        max_b_len = max([we - ws for ws, we in zip(b_starts, b_ends)]) if len(b_spans) > 0 else 0
+
+    for i, a in enumerate(a_spans):
+        lo = 0 if symmetric_relations else i
+        hi = len(b_spans)
+        if max_token_distance is not None:
+            a_start, a_end = a.get_word_start(), a.get_word_end()
+            lo = max(lo, bisect_left(b_starts, a_start - max_token_distance - 1 - max_b_len))
+            hi = bisect_right(b_starts, a_end + max_token_distance + 1)
+        for j in xrange(lo, hi):
+            b = b_spans[j]
+            if max_token_distance is not None and b_ends[j] < a_start - max_token_distance - 1:
+                continue
+
+            # Check for self-joins and "nested" joins (joins from span to its subspan)
+            same_start = a.char_start == b.char_start
+            same_end   = a.char_end == b.char_end
+            if same_start and same_end:
+                if not self_relations:
+                    continue
+            elif not nested_relations and (
+                (a.char_start <= b.char_start and b.char_end <= a.char_end) or
+                (b.char_start <= a.char_start and a.char_end <= b.char_end)):
+                continue
+            yield a, b
+
+
+def load_existing_candidate_args(session, candidate_class, first_arg_ids):
+    """
+    Returns the set of argument id tuples of the existing Candidates of candidate_class whose first argument
+    is one of first_arg_ids, for checking Candidate existence with hash lookups instead of one query each.
+    Note that Candidates are unique over their argument ids (irrespective of split).
+    """
+    arg_columns   = [getattr(candidate_class, arg_name + '_id') for arg_name in candidate_class.__argnames__]
+    first_arg_ids = list(first_arg_ids)
+    existing_args = set()
+    for i in range(0, len(first_arg_ids), EXISTENCE_CHECK_BATCH_SIZE):
+        q = select(arg_columns).where(arg_columns[0].in_(first_arg_ids[i:i+EXISTENCE_CHECK_BATCH_SIZE]))
+        existing_args.update(tuple(row) for row in session.execute(q))
+    return existing_args
+
 
 class CandidateSpace(object):
     """
@@ -133,49 +307,92 @@ class Ngrams(CandidateSpace):
         CandidateSpace.__init__(self)
         self.n_max     = n_max
         self.split_rgx = r'('+r'|'.join(split_tokens)+r')' if split_tokens and len(split_tokens) > 0 else None
-    
+
     def apply(self, context):
+        return iter(SpanBatch(context, *self.get_offsets(context)))
 
+    def get_offsets(self, context):
+        """
+        Enumerates the n-grams of a Sentence in bulk, without creating any TemporarySpans, as a pair of arrays of
+        their char_starts and (inclusive) char_ends, in the order in which apply() yields them.
+        """
         # These are the character offset--**relative to the sentence start**--for each _token_
-        offsets = context.char_offsets
-
-        # Loop over all n-grams in **reverse** order (to facilitate longest-match semantics)
-        L    = len(offsets)
-        seen = set()
-        for l in range(1, self.n_max+1)[::-1]:
-            for i in range(L-l+1):
-                w     = context.words[i+l-1]
-                start = offsets[i]
-                end   = offsets[i+l-1] + len(w) - 1
-                ts    = TemporarySpan(char_start=start, char_end=end, sentence=context)
-                if ts not in seen:
-                    seen.add(ts)
-                    yield ts
-
-                # Check for split
-                # NOTE: For simplicity, we only split single tokens right now!
-                if l == 1 and self.split_rgx is not None:
-                    m = re.search(self.split_rgx, context.text[start-offsets[0]:end-offsets[0]+1])
-                    if m is not None and l < self.n_max + 1:
-                        ts1 = TemporarySpan(char_start=start, char_end=start + m.start(1) - 1, sentence=context)
-                        if ts1 not in seen:
-                            seen.add(ts1)
-                            yield ts
-                        ts2 = TemporarySpan(char_start=start + m.end(1), char_end=end, sentence=context)
-                        if ts2 not in seen:
-                            seen.add(ts2)
-                            yield ts2
-
-
-class PretaggedCandidateExtractor(UDFRunner):
+        offsets, ends = get_token_offsets(context)
+        L             = len(offsets)
+
+        # All n-grams in **reverse** order of n (to facilitate longest-match semantics)
+        char_starts = [offsets[:L-l+1] for l in range(1, min(self.n_max, L)+1)[::-1]]
+        char_ends   = [ends[l-1:] for l in range(1, min(self.n_max, L)+1)[::-1]]
+
+        # Check for split, inserting the two pieces of each split token right after it
+        # NOTE: For simplicity, we only split single tokens right now!
+        if self.split_rgx is not None and L > 0:
+            pieces = self._get_split_pieces(context, offsets, ends)
+            if len(pieces) > 0:
+                unigram_starts, unigram_ends = [], []
+                for i, (start, end) in enumerate(zip(offsets.tolist(), ends.tolist())):
+                    unigram_starts.append(start)
+                    unigram_ends.append(end)
+                    for piece_start, piece_end in pieces.get(i, []):
+                        unigram_starts.append(piece_start)
+                        unigram_ends.append(piece_end)
+                char_starts[-1] = np.array(unigram_starts, dtype=np.int64)
+                char_ends[-1]   = np.array(unigram_ends, dtype=np.int64)
+        char_starts = np.concatenate(char_starts) if L > 0 else offsets
+        char_ends   = np.concatenate(char_ends) if L > 0 else ends
+
+        # Drop any duplicate n-grams, keeping the first occurrence
+        # NOTE: These can only occur if the tokens do not have strictly increasing offsets
+        if L > 1 and not np.all(offsets[1:] > offsets[:-1]):
+            _, idxs = np.unique(np.vstack([char_starts, char_ends]).T.copy().view([('s', np.int64), ('e', np.int64)]),
+                                return_index=True)
+            idxs.sort()
+            char_starts, char_ends = char_starts[idxs], char_ends[idxs]
+        return char_starts, char_ends
+
+    def _get_split_pieces(self, context, offsets, ends):
+        """Returns a dict mapping the index of each token to split to the (char_start, char_end) of its two pieces"""
+        # Only tokens containing a match of the split regex (found in one pass over the text) need to be searched
+        # NOTE: The text is indexed relative to the first token's offset
+        match_starts = [m.start() + offsets[0] for m in re.finditer(r'(?=' + self.split_rgx + r')', context.text)]
+        token_idxs   = np.unique(np.searchsorted(offsets, match_starts, side='right') - 1)
+        pieces       = {}
+        for i in token_idxs.tolist():
+            if i < 0:
+                continue
+            start, end = int(offsets[i]), int(ends[i])
+            m = re.search(self.split_rgx, context.text[start-offsets[0]:end-offsets[0]+1])
+            if m is not None:
+                pieces[i] = [(piece_start, piece_end) for piece_start, piece_end in
+                             [(start, start + m.start(1) - 1), (start + m.end(1), end)] if piece_end >= piece_start]
+        return pieces
+
+
+class DictionaryNgrams(Ngrams):
+    """
+    Defines the space of candidates as the n-grams (n <= n_max) in a Sentence _x_ which match against a given list
+    of phrases d--i.e., those accepted by DictionaryMatch(d=d, longest_match_only=False)--without creating any
+    TemporarySpans for the non-matching n-grams.
+    """
+    def __init__(self, d, n_max=5, split_tokens=('-', '/'), ignore_case=True, attrib='words'):
+        Ngrams.__init__(self, n_max=n_max, split_tokens=split_tokens)
+        self.trie = DictionaryTrie(d, ignore_case=ignore_case, attrib=attrib)
+
+    def get_offsets(self, context):
+        char_starts, char_ends = super(DictionaryNgrams, self).get_offsets(context)
+        mask = self.trie.match_ngrams(context, char_starts, char_ends, n_max=self.n_max)
+        return char_starts[mask], char_ends[mask]
+
+
+class PretaggedCandidateExtractor(SpanExtractor):
     """UDFRunner for PretaggedCandidateExtractorUDF"""
     def __init__(self, candidate_class, entity_types, self_relations=False,
-     nested_relations=False, symmetric_relations=True, entity_sep='~@~'):
+     nested_relations=False, symmetric_relations=True, entity_sep='~@~', bloom_filter=False):
         super(PretaggedCandidateExtractor, self).__init__(
             PretaggedCandidateExtractorUDF, candidate_class=candidate_class,
             entity_types=entity_types, self_relations=self_relations,
             nested_relations=nested_relations, entity_sep=entity_sep,
-            symmetric_relations=symmetric_relations,
+            symmetric_relations=symmetric_relations, bloom_filter=bloom_filter,
         )
 
     def apply(self, xs, split=0, **kwargs):
@@ -190,7 +407,8 @@ class PretaggedCandidateExtractorUDF(UDF):
     An extractor for Sentences with entities pre-tagged, and stored in the entity_types and entity_cids
     fields.
     """
-    def __init__(self, candidate_class, entity_types, self_relations=False, nested_relations=False, symmetric_relations=True, entity_sep='~@~', **kwargs):
+    def __init__(self, candidate_class, entity_types, self_relations=False, nested_relations=False, symmetric_relations=True, entity_sep='~@~',
+                 bloom=None, **kwargs):
         self.candidate_class     = candidate_class
         self.entity_types        = entity_types
         self.arity               = len(entity_types)
@@ -198,6 +416,7 @@ class PretaggedCandidateExtractorUDF(UDF):
         self.nested_relations    = nested_relations
         self.symmetric_relations = symmetric_relations
         self.entity_sep          = entity_sep
+        self.context_id_index    = ContextIdIndex(bloom=bloom)
 
         super(PretaggedCandidateExtractorUDF, self).__init__(**kwargs)
 
@@ -206,68 +425,186 @@ class PretaggedCandidateExtractorUDF(UDF):
         # For now, just handle Sentences
         if not isinstance(context, Sentence):
             raise NotImplementedError("%s is currently only implemented for Sentence contexts." % self.__name__)
+        entity_spans, entity_cids = self._get_entity_spans(context)
+
+        # Insert / load all temporary spans of the sentence in bulk
+        self.context_id_index.set_document(context.document_id)
+        load_ids_or_insert(self.session, chain.from_iterable(entity_spans.itervalues()), index=self.context_id_index)
+
+        # Load the argument ids of the existing candidates of this context once, for checking existence
+        if check_for_existing:
+            existing_args = load_existing_candidate_args(self.session, self.candidate_class,
+                                                         [tc.id for tc in entity_spans[self.entity_types[0]]])
+
+        # Generates and persists candidates
+        # TODO: Make the pruning work for higher-order relations
+        arg_spans = [sorted(entity_spans[et], key=span_position) for et in self.entity_types]
+        if self.arity == 2:
+            arg_tuples = span_pairs(arg_spans[0], arg_spans[1], self_relations=self.self_relations,
+                                    nested_relations=self.nested_relations, symmetric_relations=self.symmetric_relations)
+        else:
+            arg_tuples = product(*arg_spans)
+        candidate_args = {'split' : split}
+        for args in arg_tuples:
+
+            # Checking for existence
+            if check_for_existing and tuple(arg.id for arg in args) in existing_args:
+                continue
 
+            # Assemble candidate arguments
+            for i, arg_name in enumerate(self.candidate_class.__argnames__):
+                candidate_args[arg_name + '_id'] = args[i].id
+                candidate_args[arg_name + '_cid'] = entity_cids[args[i]]
+
+            # Add Candidate to session
+            yield self.candidate_class(**candidate_args)
+
+    def _get_entity_spans(self, sentence):
+        """
+        Returns the TemporarySpans of the entity mentions of sentence as a dict of lists by entity type, and a dict
+        mapping each to its entity cid
+        """
         # Do a first pass to collect all mentions by entity type / cid
         entity_idxs = dict((et, defaultdict(list)) for et in set(self.entity_types))
-        L = len(context.words)
-        for i in range(L):
-            if context.entity_types[i] is not None:
-                ets  = context.entity_types[i].split(self.entity_sep)
-                cids = context.entity_cids[i].split(self.entity_sep)
-                for et, cid in zip(ets, cids):
+        for i, (ets, cids) in enumerate(zip(sentence.entity_types, sentence.entity_cids)):
+            if ets is not None:
+                for et, cid in zip(ets.split(self.entity_sep), cids.split(self.entity_sep)):
                     if et in entity_idxs:
                         entity_idxs[et][cid].append(i)
 
-        # Form entity Spans
-        entity_spans = defaultdict(list)
-        entity_cids  = {}
+        # Form entity Spans from the runs of consecutive token indexes of each entity type / cid
+        offsets, ends = get_token_offsets(sentence)
+        entity_spans  = defaultdict(list)
+        entity_cids   = {}
         for et, cid_idxs in entity_idxs.iteritems():
-            for cid, idxs in entity_idxs[et].iteritems():
-                while len(idxs) > 0:
-                    i          = idxs.pop(0)
-                    char_start = context.char_offsets[i]
-                    char_end   = char_start + len(context.words[i]) - 1
-                    while len(idxs) > 0 and idxs[0] == i + 1:
-                        i        = idxs.pop(0)
-                        char_end = context.char_offsets[i] + len(context.words[i]) - 1
-
-                    # Insert / load temporary span, also store map to entity CID
-                    tc = TemporarySpan(char_start=char_start, char_end=char_end, sentence=context)
-                    tc.load_id_or_insert(self.session)
-                    entity_cids[tc.id] = cid
+            for cid, idxs in cid_idxs.iteritems():
+                idxs   = np.array(idxs, dtype=np.int64)
+                breaks = np.flatnonzero(np.diff(idxs) != 1) + 1
+                starts = idxs[np.concatenate([[0], breaks])]
+                stops  = idxs[np.concatenate([breaks - 1, [len(idxs) - 1]])]
+
+                # Create temporary spans, also store map to entity CID
+                for tc in SpanBatch(sentence, offsets[starts], ends[stops]):
+                    entity_cids[tc] = cid
                     entity_spans[et].append(tc)
+        return entity_spans, entity_cids
 
-        # Generates and persists candidates
-        candidate_args = {'split' : split}
-        for args in product(*[enumerate(entity_spans[et]) for et in self.entity_types]):
 
-            # TODO: Make this work for higher-order relations
-            if self.arity == 2:
-                ai, a = args[0]
-                bi, b = args[1]
+class PretaggedDocumentCandidateExtractor(SpanExtractor):
+    """
+    UDFRunner for PretaggedDocumentCandidateExtractorUDF, which extracts binary relation Candidates whose arguments
+    may be in different Sentences of a Document.
+
+    :param max_sentence_distance: the maximum difference between the positions of the Sentences of the two
+                                  arguments, or None for no limit. Default is 1, i.e. the same or adjacent Sentences.
+    :param closest_mentions_only: if True, only the closest pair of mentions of each pair of entity cids in a
+                                  Document--by sentence distance, then by order in the Document--is extracted.
+                                  Default is False.
+    See PretaggedCandidateExtractor for the other options, which apply to arguments in the same Sentence.
+    """
+    def __init__(self, candidate_class, entity_types, self_relations=False, nested_relations=False,
+                 symmetric_relations=True, entity_sep='~@~', bloom_filter=False, max_sentence_distance=1,
+                 closest_mentions_only=False):
+        super(PretaggedDocumentCandidateExtractor, self).__init__(
+            PretaggedDocumentCandidateExtractorUDF, candidate_class=candidate_class,
+            entity_types=entity_types, self_relations=self_relations,
+            nested_relations=nested_relations, entity_sep=entity_sep,
+            symmetric_relations=symmetric_relations, bloom_filter=bloom_filter,
+            max_sentence_distance=max_sentence_distance, closest_mentions_only=closest_mentions_only,
+        )
 
-                # Check for self-joins, "nested" joins (joins from span to its subspan), and flipped duplicate
-                # "symmetric" relations
-                if not self.self_relations and a == b:
-                    continue
-                elif not self.nested_relations and (a in b or b in a):
-                    continue
-                elif not self.symmetric_relations and ai > bi:
-                    continue
+    def apply(self, xs, split=0, **kwargs):
+        super(PretaggedDocumentCandidateExtractor, self).apply(xs, split=split, **kwargs)
+
+    def clear(self, session, split, **kwargs):
+        session.query(Candidate).filter(Candidate.split == split).delete()
 
-            # Assemble candidate arguments
-            for i, arg_name in enumerate(self.candidate_class.__argnames__):
-                candidate_args[arg_name + '_id'] = args[i][1].id
-                candidate_args[arg_name + '_cid'] = entity_cids[args[i][1].id]
+
+class PretaggedDocumentCandidateExtractorUDF(PretaggedCandidateExtractorUDF):
+    """
+    An extractor for Documents whose Sentences have entities pre-tagged. The entity mentions of a Document are
+    indexed by entity type and Sentence position, so that only the pairs of mentions within max_sentence_distance
+    of each other are visited.
+    """
+    def __init__(self, candidate_class, entity_types, max_sentence_distance=1, closest_mentions_only=False,
+                 **kwargs):
+        if len(entity_types) != 2:
+            raise ValueError("%s only supports binary relations." % self.__class__.__name__)
+        self.max_sentence_distance = max_sentence_distance
+        self.closest_mentions_only = closest_mentions_only
+        super(PretaggedDocumentCandidateExtractorUDF, self).__init__(candidate_class, entity_types, **kwargs)
+
+    def apply(self, context, clear, split, check_for_existing=True, **kwargs):
+        """Extract Candidates from a Document"""
+        if not isinstance(context, Document):
+            raise NotImplementedError("%s is only implemented for Document contexts." % self.__class__.__name__)
+
+        # Inverted index of the entity mentions of the Document, by entity type and Sentence position
+        mentions    = dict((et, {}) for et in self.entity_types)
+        entity_cids = {}
+        for sentence in context.sentences:
+            sentence_spans, sentence_cids = self._get_entity_spans(sentence)
+            entity_cids.update(sentence_cids)
+            for et, spans in sentence_spans.iteritems():
+                if len(spans) > 0:
+                    mentions[et][sentence.position] = sorted(spans, key=span_position)
+
+        # Insert / load all temporary spans of the document in bulk
+        self.context_id_index.set_document(context.id)
+        load_ids_or_insert(self.session, chain.from_iterable(chain.from_iterable(m.itervalues() for m in mentions.values())),
+                           index=self.context_id_index)
+
+        # Load the argument ids of the existing candidates of this context once, for checking existence
+        a_mentions, b_mentions = mentions[self.entity_types[0]], mentions[self.entity_types[1]]
+        if check_for_existing:
+            existing_args = load_existing_candidate_args(self.session, self.candidate_class,
+                                                         [tc.id for tc in chain.from_iterable(a_mentions.itervalues())])
+
+        # Generate the pairs of mentions, optionally keeping the closest one for each pair of cids
+        arg_pairs = self._get_mention_pairs(a_mentions, b_mentions)
+        if self.closest_mentions_only:
+            closest = {}
+            for n, (d, a, b) in enumerate(arg_pairs):
+                key = (entity_cids[a], entity_cids[b])
+                if key not in closest or (d, n) < closest[key][0]:
+                    closest[key] = ((d, n), a, b)
+            arg_pairs = [closest[key] for key in sorted(closest, key=lambda key: closest[key][0])]
+
+        candidate_args = {'split' : split}
+        for _, a, b in arg_pairs:
 
             # Checking for existence
-            if check_for_existing:
-                q = select([self.candidate_class.id])
-                for key, value in candidate_args.items():
-                    q = q.where(getattr(self.candidate_class, key) == value)
-                candidate_id = self.session.execute(q).first()
-                if candidate_id is not None:
-                    continue
+            if check_for_existing and (a.id, b.id) in existing_args:
+                continue
+
+            # Assemble candidate arguments
+            for arg_name, arg in zip(self.candidate_class.__argnames__, (a, b)):
+                candidate_args[arg_name + '_id'] = arg.id
+                candidate_args[arg_name + '_cid'] = entity_cids[arg]
 
             # Add Candidate to session
             yield self.candidate_class(**candidate_args)
+
+    def _get_mention_pairs(self, a_mentions, b_mentions):
+        """
+        Generates the valid (sentence distance, a, b) argument pairs, given the mentions of each argument type by
+        Sentence position. Mentions in the same Sentence are paired as by PretaggedCandidateExtractorUDF; if
+        symmetric_relations=False, mentions in different Sentences only in Document order.
+        """
+        b_positions = sorted(b_mentions)
+        for p, a_spans in sorted(a_mentions.iteritems()):
+            lo, hi = 0, len(b_positions)
+            if self.max_sentence_distance is not None:
+                lo = bisect_left(b_positions, p - self.max_sentence_distance)
+                hi = bisect_right(b_positions, p + self.max_sentence_distance)
+            if not self.symmetric_relations:
+                lo = max(lo, bisect_left(b_positions, p))
+            for q in b_positions[lo:hi]:
+                if q == p:
+                    pairs = span_pairs(a_spans, b_mentions[q], self_relations=self.self_relations,
+                                       nested_relations=self.nested_relations,
+                                       symmetric_relations=self.symmetric_relations)
+                else:
+                    pairs = product(a_spans, b_mentions[q])
+                for a, b in pairs:
+                    yield abs(q - p), a, b
@@ -1,6 +1,11 @@
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+import numpy as np
 import os
 import re
 import warnings
+
+from .models import TemporarySpan, get_token_offsets
 # Travis will not import the PorterStemmer
 if 'CI' not in os.environ:
     try:
@@ -15,6 +20,10 @@ class Matcher(object):
     returning only candidates _c_ s.t. _f(c) == True_,
     where f can be compositionally defined.
     """
+    # Whether f evaluates the children on many overlapping sub-spans of c (e.g. Concat, at every word boundary), so
+    # that a MatcherPlan pays off by reusing their results
+    slices_candidates = False
+
     def __init__(self, *children, **opts):
         self.children           = children
         self.opts               = opts
@@ -46,10 +55,14 @@ class Matcher(object):
         if len(self.children) == 0:
             return self._f(c)
         elif len(self.children) == 1:
-            return self._f(c) and self.children[0].f(c)
+            return self._f(c) and self._child_f(self.children[0], c)
         else:
             raise Exception("%s does not support more than one child Matcher" % self.__name__)
 
+    def _child_f(self, child, c):
+        """Evaluates a child Matcher on c, through the MatcherPlan of c if it is a PlanSpan"""
+        return c.plan.f(child, c) if isinstance(c, PlanSpan) else child.f(c)
+
     def _is_subspan(self, c, span):
         """Tests if candidate c is subspan of span, where span is defined specific to candidate type"""
         return False
@@ -73,6 +86,129 @@ class Matcher(object):
 
 WORDS = 'words'
 
+class PlanSpan(TemporarySpan):
+    """
+    A TemporarySpan which memoizes its attributes, and the results of the Matchers evaluated on it, within a
+    MatcherPlan. Its slices are shared with the other spans of the plan.
+    """
+    __slots__ = ('plan', 'results', '_cache')
+
+    def __init__(self, plan, sentence, char_start, char_end):
+        super(PlanSpan, self).__init__(sentence=sentence, char_start=char_start, char_end=char_end)
+        self.plan    = plan
+        self.results = None
+        self._cache  = None
+
+    def char_to_word_index(self, ci):
+        try:
+            return self.plan.word_indexes[ci]
+        except KeyError:
+            wi = self.plan.word_indexes[ci] = super(PlanSpan, self).char_to_word_index(ci)
+            return wi
+
+    def get_attrib_tokens(self, a='words'):
+        if self._cache is None:
+            self._cache = {}
+        try:
+            return self._cache[a]
+        except KeyError:
+            tokens = self._cache[a] = super(PlanSpan, self).get_attrib_tokens(a)
+            return tokens
+
+    def get_attrib_span(self, a, sep=" "):
+        if a == WORDS:
+            return self.sentence.text[self.char_start:self.char_end + 1]
+        if self._cache is None:
+            self._cache = {}
+        try:
+            return self._cache[(a, sep)]
+        except KeyError:
+            span = self._cache[(a, sep)] = super(PlanSpan, self).get_attrib_span(a, sep=sep)
+            return span
+
+    def _get_instance(self, char_start, char_end, **kwargs):
+        return self.plan.span(char_start, char_end)
+
+
+class MatcherPlan(object):
+    """
+    A Matcher tree compiled for evaluation over the spans of one Sentence at a time: the spans passed to the nodes of
+    the tree, including the sub-spans that composed Matchers slice, are shared and memoize their attributes, and each
+    child node is evaluated at most once per span.
+    """
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self.set_sentence(None)
+
+    @staticmethod
+    def reuses_results(matcher):
+        """Tests if any Matcher of the tree evaluates its children on many sub-spans, i.e. if a MatcherPlan helps"""
+        stack = [matcher]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node.slices_candidates:
+                return True
+            stack.extend(node.children)
+        return False
+
+    def set_sentence(self, sentence):
+        self.sentence     = sentence
+        self.spans        = {}
+        self.word_indexes = {}
+
+    def span(self, char_start, char_end):
+        """Returns the shared span of the current sentence"""
+        try:
+            return self.spans[(char_start, char_end)]
+        except KeyError:
+            s = self.spans[(char_start, char_end)] = PlanSpan(self, self.sentence, char_start, char_end)
+            return s
+
+    def apply(self, c):
+        """Evaluates the root of the tree on span c"""
+        if c.sentence is not self.sentence:
+            self.set_sentence(c.sentence)
+        return self.matcher.f(self.span(c.char_start, c.char_end))
+
+    def f(self, matcher, c):
+        """Evaluates node matcher of the tree on span c of the plan"""
+        if c.results is None:
+            c.results = {}
+        try:
+            return c.results[matcher]
+        except KeyError:
+            r = c.results[matcher] = matcher.f(c)
+            return r
+
+
+class SpanIndex(object):
+    """
+    Index of the (inclusive) character intervals accepted so far in a sentence, for longest_match_only.
+
+    Only the maximal intervals, i.e. those not contained in another, are kept, sorted by start; their ends are then
+    also sorted, so whether an interval is contained in one of them is decided by a single bisection.
+    """
+    def __init__(self):
+        self.starts = []
+        self.ends   = []
+
+    def covers(self, char_start, char_end):
+        """Tests if the interval is contained in an interval of the index"""
+        k = bisect_right(self.starts, char_start) - 1
+        return k >= 0 and self.ends[k] >= char_end
+
+    def add(self, char_start, char_end):
+        """Adds the interval, dropping the intervals of the index that it contains"""
+        if self.covers(char_start, char_end):
+            return
+        lo = bisect_left(self.starts, char_start)
+        hi = lo
+        while hi < len(self.ends) and self.ends[hi] <= char_end:
+            hi += 1
+        self.starts[lo:hi] = [char_start]
+        self.ends[lo:hi]   = [char_end]
+
+
 class NgramMatcher(Matcher):
     """Matcher base class for Ngram objects"""
     def _is_subspan(self, c, span):
@@ -83,6 +219,183 @@ class NgramMatcher(Matcher):
         """Gets a tuple that identifies a span for the specific candidate class that c belongs to"""
         return (c.char_start, c.char_end)
 
+    def compile(self):
+        """Compiles the Matcher tree into a MatcherPlan, or returns None if the tree does not reuse sub-span results"""
+        return MatcherPlan(self) if MatcherPlan.reuses_results(self) else None
+
+    def apply(self, candidates):
+        """
+        Apply the Matcher to a **generator** of candidates
+        Optionally only takes the longest match (NOTE: assumes this is the *first* match)
+        """
+        plan       = self.compile()
+        f          = self.f if plan is None else plan.apply
+        seen_spans = SpanIndex()
+        try:
+            for c in candidates:
+                if self.longest_match_only and seen_spans.covers(c.char_start, c.char_end):
+                    continue
+                if f(c):
+                    if self.longest_match_only:
+                        seen_spans.add(c.char_start, c.char_end)
+                    yield c
+        finally:
+            if plan is not None:
+                plan.set_sentence(None)
+
+    def apply_ngrams(self, sentence, char_starts, char_ends):
+        """
+        Apply the Matcher to the n-grams of a Sentence given as arrays of char_starts and char_ends, e.g. as
+        enumerated by Ngrams.get_offsets, creating TemporarySpans only for the n-grams that are matched.
+        Same semantics as apply(Ngrams.apply(sentence)).
+
+        NOTE: If every Matcher of the tree is one of the built-in PURE_MATCHERS, which do not hold on to the candidates
+        they are passed, f is evaluated on a single TemporarySpan which is moved along the n-grams; other Matchers,
+        e.g. LambdaFunctionMatch, are passed a new TemporarySpan per n-gram.
+        """
+        mask = self.get_mask(sentence, char_starts, char_ends)
+        if mask is not None:
+            return self._apply_mask(sentence, char_starts, char_ends, mask)
+        return self._apply_cursor(sentence, char_starts, char_ends)
+
+    def get_mask(self, sentence, char_starts, char_ends):
+        """
+        Returns a boolean mask over the n-grams of sentence given by arrays char_starts, char_ends indicating which are
+        accepted by f, if the Matcher can evaluate f on all n-grams at once, else None
+        """
+        return None
+
+    def is_pure(self):
+        """Tests if every Matcher of the tree is one of the built-in PURE_MATCHERS"""
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            if type(node) not in PURE_MATCHERS:
+                return False
+            stack.extend(node.children)
+        return True
+
+    def _apply_cursor(self, sentence, char_starts, char_ends):
+        """Like apply_ngrams, evaluating f on each n-gram"""
+        plan       = self.compile()
+        f          = self.f if plan is None else plan.apply
+        cursor     = TemporarySpan(sentence=sentence, char_start=0, char_end=0) if self.is_pure() else None
+        seen_spans = SpanIndex()
+        try:
+            for char_start, char_end in zip(char_starts.tolist(), char_ends.tolist()):
+                if self.longest_match_only and seen_spans.covers(char_start, char_end):
+                    continue
+                if cursor is not None:
+                    cursor.char_start = char_start
+                    cursor.char_end   = char_end
+                    c                 = cursor
+                else:
+                    c = TemporarySpan(sentence=sentence, char_start=char_start, char_end=char_end)
+                if f(c):
+                    if self.longest_match_only:
+                        seen_spans.add(char_start, char_end)
+                    yield c if cursor is None else TemporarySpan(sentence=sentence, char_start=char_start,
+                                                                 char_end=char_end)
+        finally:
+            if plan is not None:
+                plan.set_sentence(None)
+
+    def _apply_mask(self, sentence, char_starts, char_ends, mask):
+        """Like apply_ngrams, for a Matcher whose f has already been evaluated on all n-grams, given as a boolean mask"""
+        seen_spans = SpanIndex()
+        for char_start, char_end in zip(char_starts[mask].tolist(), char_ends[mask].tolist()):
+            if self.longest_match_only:
+                if seen_spans.covers(char_start, char_end):
+                    continue
+                seen_spans.add(char_start, char_end)
+            yield TemporarySpan(sentence=sentence, char_start=char_start, char_end=char_end)
+
+
+class DictionaryTrie(object):
+    """
+    A list of phrases compiled for matching against all of the n-grams of a Sentence at once.
+
+    The phrases are kept sorted, so that the set of phrases starting with a given string--i.e. a node of the
+    equivalent character trie--is found by a single bisection, without the memory overhead of a pointer-based trie
+    for large dictionaries. Token-aligned n-grams are then matched in one left-to-right pass over the tokens,
+    extending each n-gram only while it is still a prefix of some phrase.
+    """
+    PREFIX_LEN = 3
+
+    def __init__(self, phrases, ignore_case=True, attrib=WORDS, sep=" "):
+        self.ignore_case = ignore_case
+        self.attrib      = attrib
+        self.sep         = sep
+        self.phrases     = sorted(set(p.lower() if ignore_case else p for p in phrases))
+
+        # Hash index from the first PREFIX_LEN characters of the phrases to their range in the sorted list, so that
+        # most strings can be ruled out without bisecting, and the others are bisected within a small range
+        self.ranges = {}
+        for k, p in enumerate(self.phrases):
+            if len(p) >= self.PREFIX_LEN:
+                lo, _ = self.ranges.get(p[:self.PREFIX_LEN], (k, k))
+                self.ranges[p[:self.PREFIX_LEN]] = (lo, k + 1)
+
+    def _bisect(self, p):
+        """Returns the index of the first phrase >= p, and the end of the range of phrases that can start with p"""
+        if len(p) < self.PREFIX_LEN:
+            return bisect_left(self.phrases, p), len(self.phrases)
+        lo, hi = self.ranges.get(p[:self.PREFIX_LEN], (0, 0))
+        return bisect_left(self.phrases, p, lo, hi), hi
+
+    def __contains__(self, p):
+        k, hi = self._bisect(p)
+        return k < hi and self.phrases[k] == p
+
+    def _get_token_string(self, sentence):
+        """Returns the string that attrib spans are sliced from, and the start and end of each token in it"""
+        if self.attrib == WORDS:
+            s      = sentence.text
+            starts = list(sentence.char_offsets)
+            ends   = [start + len(w) - 1 for start, w in zip(starts, sentence.words)]
+        else:
+            tokens = sentence.__getattribute__(self.attrib)
+            s      = self.sep.join(tokens)
+            starts, ends, start = [], [], 0
+            for t in tokens:
+                starts.append(start)
+                ends.append(start + len(t) - 1)
+                start += len(t) + len(self.sep)
+        return (s.lower() if self.ignore_case else s), starts, ends
+
+    def find(self, sentence, n_max=None):
+        """Generates the (inclusive) word index ranges (i, j) of all the n-grams of sentence which are phrases"""
+        s, starts, ends = self._get_token_string(sentence)
+        L = len(starts)
+        for i in xrange(L):
+            for j in xrange(i, L if n_max is None else min(L, i + n_max)):
+                p     = s[starts[i]:ends[j] + 1]
+                k, hi = self._bisect(p)
+                if k == hi or not self.phrases[k].startswith(p):
+                    break
+                if self.phrases[k] == p:
+                    yield i, j
+
+    def match_ngrams(self, sentence, char_starts, char_ends, n_max=None):
+        """
+        Returns a boolean mask over the n-grams of sentence given by arrays char_starts, char_ends, e.g. as
+        enumerated by Ngrams.get_offsets, indicating which n-grams are phrases.
+        """
+        offsets, ends = get_token_offsets(sentence)
+        aligned = np.in1d(char_starts, offsets) & np.in1d(char_ends, ends)
+
+        # Token-aligned n-grams are matched by walking the sentence
+        K       = max(ends.max() if len(ends) > 0 else 0, char_ends.max() if len(char_ends) > 0 else 0) + 1
+        matches = [offsets[i] * K + ends[j] for i, j in self.find(sentence, n_max=n_max)]
+        mask    = aligned & np.in1d(char_starts * K + char_ends, matches)
+
+        # Other n-grams (e.g. pieces of split tokens) are looked up individually
+        for idx in np.flatnonzero(~aligned).tolist():
+            ts = TemporarySpan(sentence=sentence, char_start=int(char_starts[idx]), char_end=int(char_ends[idx]))
+            p  = ts.get_attrib_span(self.attrib, sep=self.sep)
+            mask[idx] = (p.lower() if self.ignore_case else p) in self
+        return mask
+
 
 class DictionaryMatch(NgramMatcher):
     """Selects candidate Ngrams that match against a given list d"""
@@ -103,6 +416,9 @@ class DictionaryMatch(NgramMatcher):
                 self.stemmer = PorterStemmer()
             self.d = frozenset(self._stem(w) for w in list(self.d))
 
+        # Compiled version of d, built on first use by apply_ngrams
+        self.trie = None
+
     def _stem(self, w):
         """Apply stemmer, handling encoding errors"""
         try:
@@ -116,6 +432,15 @@ class DictionaryMatch(NgramMatcher):
         p = self._stem(p) if self.stemmer is not None else p
         return (not self.reverse) if p in self.d else self.reverse
 
+    def get_mask(self, sentence, char_starts, char_ends):
+        # Without a stemmer (which is applied to whole phrases), the dictionary is matched against all n-grams at once
+        if self.stemmer is not None or len(self.children) > 0:
+            return None
+        if self.trie is None:
+            self.trie = DictionaryTrie(self.d, ignore_case=self.ignore_case, attrib=self.attrib)
+        mask = self.trie.match_ngrams(sentence, char_starts, char_ends)
+        return ~mask if self.reverse else mask
+
 class LambdaFunctionMatch(NgramMatcher):
     """Selects candidate Ngrams that match against a given list d"""
     def init(self):
@@ -133,9 +458,49 @@ class LambdaFunctionMatch(NgramMatcher):
 
 class Union(NgramMatcher):
     """Takes the union of candidate sets returned by child operators"""
+    def init(self):
+        # Leaf RegexMatchSpan (resp. RegexMatchEach) children with the same options are matched at once with a RegexSet
+        # on the span (resp. used to rule out all of them at once by a token that matches none)
+        regex_children = defaultdict(list)
+        for child in self.children:
+            if type(child) in (RegexMatchSpan, RegexMatchEach) and len(child.children) == 0:
+                regex_children[(type(child), child.attrib, child.sep, child.ignore_case)].append(child)
+        self._regex_sets  = []
+        self._each_filter = {}
+        grouped           = set()
+        for (cls, attrib, sep, ignore_case), children in regex_children.iteritems():
+            if len(children) > 1:
+                regex_set = RegexSet([child.rgx for child in children], flags=re.I if ignore_case else 0)
+                if cls is RegexMatchSpan:
+                    self._regex_sets.append((attrib, sep, regex_set))
+                    grouped.update(id(child) for child in children)
+                else:
+                    for child in children:
+                        self._each_filter[id(child)] = (attrib, regex_set)
+        self._children = [child for child in self.children if id(child) not in grouped]
+
+    def get_mask(self, sentence, char_starts, char_ends):
+        mask = np.zeros(len(char_starts), dtype=bool)
+        for child in self.children:
+            child_mask = child.get_mask(sentence, char_starts, char_ends)
+            if child_mask is None:
+                return None
+            mask |= child_mask
+        return mask
+
     def f(self, c):
-       for child in self.children:
-           if child.f(c) > 0:
+       for attrib, sep, regex_set in self._regex_sets:
+           if regex_set.match(c.get_attrib_span(attrib, sep=sep)) is not None:
+               return True
+       possible = {}
+       for child in self._children:
+           if id(child) in self._each_filter:
+               attrib, regex_set = self._each_filter[id(child)]
+               if regex_set not in possible:
+                   possible[regex_set] = all(regex_set.match(t) is not None for t in c.get_attrib_tokens(attrib))
+               if not possible[regex_set]:
+                   continue
+           if self._child_f(child, c) > 0:
                return True
        return False
 
@@ -145,6 +510,8 @@ class Concat(NgramMatcher):
     Selects candidates which are the concatenation of adjacent matches from child operators
     NOTE: Currently slices on **word index** and considers concatenation along these divisions only
     """
+    slices_candidates = True
+
     def init(self):
         self.permutations   = self.opts.get('permutations', False)
         self.left_required  = self.opts.get('left_required', True)
@@ -155,22 +522,23 @@ class Concat(NgramMatcher):
     def f(self, c):
         if len(self.children) != 2:
             raise ValueError("Concat takes two child Matcher objects as arguments.")
-        if not self.left_required and self.children[1].f(c):
+        if not self.left_required and self._child_f(self.children[1], c):
             return True
-        if not self.right_required and self.children[0].f(c):
+        if not self.right_required and self._child_f(self.children[0], c):
             return True
 
         # Iterate over candidate splits **at the word boundaries**
+        span = c.get_span()
         for wsplit in range(c.get_word_start()+1, c.get_word_end()+1):
             csplit = c.word_to_char_index(wsplit) - c.char_start  # NOTE the switch to **candidate-relative** char index
 
             # Optionally check for specific separator
-            if self.ignore_sep or c.get_span()[csplit-1] == self.sep:
+            if self.ignore_sep or span[csplit-1] == self.sep:
                 c1 = c[:csplit-len(self.sep)]
                 c2 = c[csplit:]
-                if self.children[0].f(c1) and self.children[1].f(c2):
+                if self._child_f(self.children[0], c1) and self._child_f(self.children[1], c2):
                     return True
-                if self.permutations and self.children[1].f(c1) and self.children[0].f(c2):
+                if self.permutations and self._child_f(self.children[1], c1) and self._child_f(self.children[0], c2):
                     return True
         return False
 
@@ -188,6 +556,7 @@ class SlotFillMatch(NgramMatcher):
         split        = re.split(r'\{(\d+)\}', self.pattern)
         self._ops    = map(int, split[1::2])
         self._splits = split[::2]
+        self._r      = re.compile(r'(.+)'.join(self._splits) + r'$')
 
         # NOTE: Must have non-null splits!!
         if any([len(s) == 0 for s in self._splits[1:-1]]):
@@ -201,17 +570,67 @@ class SlotFillMatch(NgramMatcher):
     def f(self, c):
 
         # First, filter candidates by matching splits pattern
-        m = re.match(r'(.+)'.join(self._splits) + r'$', c.get_attrib_span(self.attrib))
+        m = self._r.match(c.get_attrib_span(self.attrib))
         if m is None:
             return False
 
         # Then, recursively apply matchers
         for i,op in enumerate(self._ops):
-            if self.children[op].f(c[m.start(i+1):m.end(i+1)]) == 0:
+            if self._child_f(self.children[op], c[m.start(i+1):m.end(i+1)]) == 0:
                 return False
         return True
 
 
+class RegexSet(object):
+    """
+    A list of regular expressions combined into alternations, so that whether any of them matches (the start of) a
+    string, and which, is found by a single match per alternation of up to MAX_GROUPS capturing groups.
+
+    Expressions with backreferences or inline flags, which cannot be combined, are matched on their own; expressions
+    which reuse a group name are put in separate alternations.
+    """
+    MAX_GROUPS = 99
+    UNSAFE_RGX = re.compile(r'\\[1-9]|\(\?P=|\(\?[iLmsux]+\)')
+
+    def __init__(self, patterns, flags=0):
+        self.patterns = list(patterns)
+        self.combined = []
+        chunk, n, names = [], 0, set()
+        for k, p in enumerate(self.patterns):
+            r = re.compile(p, flags)
+            if self.UNSAFE_RGX.search(p) is not None:
+                self.combined.append((r, k))
+                continue
+            if n + r.groups + 1 > self.MAX_GROUPS or not names.isdisjoint(r.groupindex):
+                self._add_chunk(chunk, flags)
+                chunk, n, names = [], 0, set()
+            chunk.append((k, p, r))
+            n += r.groups + 1
+            names.update(r.groupindex)
+        self._add_chunk(chunk, flags)
+
+    def _add_chunk(self, chunk, flags):
+        """Compiles an alternation of the patterns in chunk, mapping the group wrapping each to its index"""
+        if len(chunk) == 0:
+            return
+        ids, g = {}, 1
+        for k, p, r in chunk:
+            ids[g] = k
+            g     += r.groups + 1
+        try:
+            self.combined.append((re.compile('|'.join('(%s)' % p for k, p, r in chunk), flags), ids))
+        except re.error:
+            self.combined.extend((r, k) for k, p, r in chunk)
+
+    def match(self, s):
+        """Returns the index of a pattern which matches s, or None"""
+        for r, ids in self.combined:
+            m = r.match(s)
+            if m is not None:
+                return ids if isinstance(ids, int) else ids[m.lastindex]
+        return None
+
+
 class RegexMatch(NgramMatcher):
     """Base regex class- does not specify specific semantics of *what* is being matched yet"""
     def init(self):
@@ -245,79 +664,145 @@ class RegexMatchEach(RegexMatch):
         return True if tokens and all([self.r.match(t) is not None for t in tokens]) else False
 
 
-class PersonMatcher(RegexMatchEach):
+class SegmentIndex(object):
+    """Run-length index of the segments of equal consecutive tags in a sequence, e.g. the ner_tags of a Sentence"""
+    def __init__(self, tags):
+        self.tags    = list(tags)
+        is_start     = np.array([i == 0 or self.tags[i] != self.tags[i-1] for i in xrange(len(self.tags))], dtype=bool)
+        self.starts  = np.flatnonzero(is_start)
+        self.ends    = np.append(self.starts[1:] - 1, len(self.tags) - 1) if len(self.tags) > 0 else self.starts
+        self.run_ids = np.cumsum(is_start) - 1
+
+    def get_tags(self):
+        """Returns the tag of each segment"""
+        return [self.tags[i] for i in self.starts.tolist()]
+
+    def segments(self, tag):
+        """Generates the (inclusive) word index ranges of the segments with tag"""
+        for i, j in zip(self.starts.tolist(), self.ends.tolist()):
+            if self.tags[i] == tag:
+                yield i, j
+
+
+def get_segment_index(sentence, ignore_case=False):
+    """
+    Returns the SegmentIndex of the ner_tags of sentence, lower-cased if ignore_case (so that tags which only differ
+    in case are in the same segment), cached on the sentence until its ner_tags are replaced
+    """
+    cache = getattr(sentence, '_segment_indexes', None)
+    if cache is None or cache[0] is not sentence.ner_tags:
+        cache = (sentence.ner_tags, {})
+        sentence._segment_indexes = cache
+    if ignore_case not in cache[1]:
+        tags = [t.lower() for t in sentence.ner_tags] if ignore_case else sentence.ner_tags
+        cache[1][ignore_case] = SegmentIndex(tags)
+    return cache[1][ignore_case]
+
+
+class EntityMatcher(RegexMatchEach):
+    """
+    Matches Spans of which every token was tagged with ner_tag, as identified by CoreNLP.
+
+    The n-grams of a Sentence are matched at once against the SegmentIndex of its ner_tags, which is shared by the
+    EntityMatchers applied to the Sentence; get_segments directly generates the longest matches among the n-grams
+    of the Sentence, in O(segments).
+    """
+    ner_tag = None
+
+    def __init__(self, *children, **kwargs):
+        kwargs['attrib'] = 'ner_tags'
+        kwargs['rgx']    = self.ner_tag
+        super(EntityMatcher, self).__init__(*children, **kwargs)
+
+    def get_mask(self, sentence, char_starts, char_ends):
+        if len(self.children) > 0:
+            return None
+        index   = get_segment_index(sentence, self.ignore_case)
+        tag     = self.ner_tag.lower() if self.ignore_case else self.ner_tag
+        matches = np.array([t == tag for t in index.get_tags()] + [False], dtype=bool)
+
+        # The n-grams within a single segment of the tag are matched (with a sentinel segment for any char index
+        # before the first token)
+        offsets, _ = get_token_offsets(sentence)
+        run_ids    = np.append(index.run_ids, -1)
+        starts     = run_ids[np.searchsorted(offsets, char_starts, side='right') - 1]
+        ends       = run_ids[np.searchsorted(offsets, char_ends, side='right') - 1]
+        return (starts == ends) & matches[starts]
+
+    def get_segments(self, sentence, n_max=None):
+        """
+        Generates the TemporarySpans of sentence matched by apply_ngrams(sentence, *Ngrams(n_max).get_offsets(sentence))
+        with longest_match_only, in any order: the segments of ner_tag, or if longer than n_max tokens, their windows of
+        n_max tokens. Assumes that the tokens have strictly increasing offsets.
+        """
+        offsets, ends = get_token_offsets(sentence)
+        tag           = self.ner_tag.lower() if self.ignore_case else self.ner_tag
+        for i, j in get_segment_index(sentence, self.ignore_case).segments(tag):
+            n = j - i + 1 if n_max is None else min(n_max, j - i + 1)
+            for k in xrange(i, j - n + 2):
+                yield TemporarySpan(sentence=sentence, char_start=int(offsets[k]), char_end=int(ends[k + n - 1]))
+
+
+class PersonMatcher(EntityMatcher):
     """
     Matches Spans that are the names of people, as identified by CoreNLP.
 
     A convenience class for setting up a RegexMatchEach to match spans
     for which each token was tagged as a person.
     """
-    def __init__(self, *children, **kwargs):
-        kwargs['attrib'] = 'ner_tags'
-        kwargs['rgx'] = 'PERSON'
-        super(PersonMatcher, self).__init__(*children, **kwargs)
+    ner_tag = 'PERSON'
 
 
-class LocationMatcher(RegexMatchEach):
+class LocationMatcher(EntityMatcher):
     """
     Matches Spans that are the names of locations, as identified by CoreNLP.
 
     A convenience class for setting up a RegexMatchEach to match spans
     for which each token was tagged as a location.
     """
-    def __init__(self, *children, **kwargs):
-        kwargs['attrib'] = 'ner_tags'
-        kwargs['rgx'] = 'LOCATION'
-        super(LocationMatcher, self).__init__(*children, **kwargs)
+    ner_tag = 'LOCATION'
 
 
-class OrganizationMatcher(RegexMatchEach):
+class OrganizationMatcher(EntityMatcher):
     """
     Matches Spans that are the names of organizations, as identified by CoreNLP.
 
     A convenience class for setting up a RegexMatchEach to match spans
     for which each token was tagged as an organization.
     """
-    def __init__(self, *children, **kwargs):
-        kwargs['attrib'] = 'ner_tags'
-        kwargs['rgx'] = 'ORGANIZATION'
-        super(OrganizationMatcher, self).__init__(*children, **kwargs)
+    ner_tag = 'ORGANIZATION'
 
 
-class DateMatcher(RegexMatchEach):
+class DateMatcher(EntityMatcher):
     """
     Matches Spans that are dates, as identified by CoreNLP.
 
     A convenience class for setting up a RegexMatchEach to match spans
     for which each token was tagged as a date.
     """
-    def __init__(self, *children, **kwargs):
-        kwargs['attrib'] = 'ner_tags'
-        kwargs['rgx'] = 'DATE'
-        super(DateMatcher, self).__init__(*children, **kwargs)
+    ner_tag = 'DATE'
 
 
-class NumberMatcher(RegexMatchEach):
+class NumberMatcher(EntityMatcher):
     """
     Matches Spans that are numbers, as identified by CoreNLP.
 
     A convenience class for setting up a RegexMatchEach to match spans
     for which each token was tagged as a number.
     """
-    def __init__(self, *children, **kwargs):
-        kwargs['attrib'] = 'ner_tags'
-        kwargs['rgx'] = 'NUMBER'
-        super(NumberMatcher, self).__init__(*children, **kwargs)
+    ner_tag = 'NUMBER'
 
 
-class MiscMatcher(RegexMatchEach):
+class MiscMatcher(EntityMatcher):
     """
     Matches Spans that are miscellaneous named entities, as identified by CoreNLP.
 
     A convenience class for setting up a RegexMatchEach to match spans
     for which each token was tagged as miscellaneous.
     """
-    def __init__(self, *children, **kwargs):
-        kwargs['attrib'] = 'ner_tags'
-        kwargs['rgx'] = 'MISC'
-        super(MiscMatcher, self).__init__(*children, **kwargs)
+    ner_tag = 'MISC'
+
+
+# Built-in Matchers whose f does not hold on to the candidates it is passed, nor depend on their identity
+PURE_MATCHERS = frozenset([DictionaryMatch, Union, Concat, SlotFillMatch, RegexMatchSpan, RegexMatchEach, PersonMatcher,
+                           LocationMatcher, OrganizationMatcher, DateMatcher, NumberMatcher, MiscMatcher])
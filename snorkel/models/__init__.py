@@ -36,10 +36,12 @@ define a new type of Context is:
     import snorkel.models
 """
 from .meta import SnorkelBase, SnorkelSession, snorkel_engine, snorkel_postgres
-from .context import Context, Document, Sentence, TemporarySpan, Span
-from .context import construct_stable_id, split_stable_id
+from .context import Context, Document, Sentence, TemporarySpan, Span, SpanBatch
+from .context import construct_stable_id, split_stable_id, load_ids_or_insert, ContextIdIndex, get_token_offsets
+from .context import build_context_bloom_filter
 from .candidate import Candidate, candidate_subclass
 from .annotation import Feature, FeatureKey, Label, LabelKey, GoldLabel, GoldLabelKey, StableLabel, Prediction, PredictionKey
+from .annotation import AnnotationRun, LabelKeyFingerprint, new_annotation_run, get_annotation_runs
 from .parameter import Parameter
 
 # This call must be performed after all classes that extend SnorkelBase are
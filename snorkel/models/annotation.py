@@ -1,6 +1,7 @@
 from sqlalchemy import Column, String, Integer, Float, ForeignKey, UniqueConstraint
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import relationship, backref
+from uuid import uuid4
 
 from .meta import SnorkelBase
 from ..utils import camel_to_under
@@ -149,3 +150,46 @@ class StableLabel(SnorkelBase):
 
     def __repr__(self):
         return "%s (%s : %s)" % (self.__class__.__name__, self.annotator_name, self.value)
+
+
+class LabelKeyFingerprint(SnorkelBase):
+    """
+    The fingerprint of the definition of the labeling function of a LabelKey, see snorkel.annotations.lf_fingerprint.
+    Kept in a separate table, so that databases created before fingerprints were introduced need no migration.
+    """
+    __tablename__ = 'label_key_fingerprint'
+    key_id      = Column(Integer, ForeignKey('label_key.id', ondelete='CASCADE'), primary_key=True)
+    fingerprint = Column(String, nullable=False)
+
+    def __repr__(self):
+        return "%s (%s : %s)" % (self.__class__.__name__, self.key_id, self.fingerprint)
+
+
+class AnnotationRun(SnorkelBase):
+    """
+    The id of the last run writing to a table, e.g. of an Annotator to its annotation table, or of a CandidateExtractor
+    to the candidate table. Renewed by every such run, it identifies the state of the table, so that files derived
+    from the table (e.g. cached annotation matrices) can be checked for validity.
+    """
+    __tablename__ = 'annotation_run'
+    table_name = Column(String, primary_key=True)
+    run_id     = Column(String, nullable=False)
+
+    def __repr__(self):
+        return "%s (%s : %s)" % (self.__class__.__name__, self.table_name, self.run_id)
+
+
+def new_annotation_run(session, table_name):
+    """Sets and returns a new AnnotationRun id for the table"""
+    run_id = uuid4().hex
+    q      = AnnotationRun.__table__.update().where(AnnotationRun.table_name == table_name).values(run_id=run_id)
+    if session.execute(q).rowcount == 0:
+        session.execute(AnnotationRun.__table__.insert(), {'table_name': table_name, 'run_id': run_id})
+    return run_id
+
+
+def get_annotation_runs(session, table_names):
+    """Returns the AnnotationRun ids of the tables, or None for tables which have not been written by a run"""
+    q    = session.query(AnnotationRun.table_name, AnnotationRun.run_id)
+    runs = dict(q.filter(AnnotationRun.table_name.in_(frozenset(table_names))).all())
+    return tuple(runs.get(table_name) for table_name in table_names)
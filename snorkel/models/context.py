@@ -1,9 +1,15 @@
-from .meta import SnorkelBase, snorkel_postgres
+from bisect import bisect_right
+from collections import defaultdict
+import numpy as np
+
+from .meta import SnorkelBase, rows_per_statement, snorkel_postgres
 from sqlalchemy import Column, String, Integer, Text, ForeignKey, UniqueConstraint
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.types import PickleType
-from sqlalchemy.sql import select, text
+from sqlalchemy.sql import func, select, text
+
+from ..utils import BloomFilter
 
 
 class Context(SnorkelBase):
@@ -136,6 +142,8 @@ class TemporaryContext(object):
     A TemporaryContext must have specified equality / set membership semantics, a stable_id for checking
     uniqueness against the database, and a promote() method which returns a corresponding Context object.
     """
+    __slots__ = ('id',)
+
     def __init__(self):
         self.id = None
 
@@ -178,34 +186,65 @@ class TemporaryContext(object):
         raise NotImplementedError()
 
 
+def get_token_offsets(sentence):
+    """
+    Returns the char_starts and (inclusive) char_ends of the tokens of sentence as a pair of NumPy arrays, cached on
+    the sentence until its char_offsets or words are replaced
+    """
+    cache = getattr(sentence, '_token_offsets', None)
+    if cache is None or cache[0] is not sentence.char_offsets or cache[1] is not sentence.words:
+        starts = np.asarray(sentence.char_offsets, dtype=np.int64)
+        ends   = starts + np.array([len(w) for w in sentence.words], dtype=np.int64) - 1
+        cache  = (sentence.char_offsets, sentence.words, starts, ends)
+        sentence._token_offsets = cache
+    return cache[2], cache[3]
+
+
 class TemporarySpan(TemporaryContext):
-    """The TemporaryContext version of Span"""
+    """
+    The TemporaryContext version of Span
+
+    TemporarySpans are slotted, and identified by the integers (sentence_id, char_start, char_end), since very many
+    of them are created and hashed during candidate extraction.
+    """
+    __slots__ = ('sentence', 'sentence_id', 'char_start', 'char_end', 'meta', '_word_start', '_word_end')
+
     def __init__(self, sentence, char_start, char_end, meta=None):
         super(TemporarySpan, self).__init__()
-        self.sentence     = sentence  # The sentence Context of the Span
-        self.char_end   = char_end
-        self.char_start = char_start
-        self.meta       = meta
+        self.sentence    = sentence  # The sentence Context of the Span
+        self.sentence_id = sentence.id
+        self.char_end    = char_end
+        self.char_start  = char_start
+        self.meta        = meta
+        self._word_start = None
+        self._word_end   = None
 
     def __len__(self):
         return self.char_end - self.char_start + 1
 
     def __eq__(self, other):
         try:
-            return self.sentence == other.sentence and self.char_start == other.char_start \
-                and self.char_end == other.char_end
+            # NOTE: Spans of Sentences without ids yet are equal only if their Sentence is the same object
+            return self.char_start == other.char_start and self.char_end == other.char_end \
+                and self.sentence_id == other.sentence_id \
+                and (self.sentence_id is not None or self.sentence is other.sentence)
         except AttributeError:
             return False
 
     def __ne__(self, other):
-        try:
-            return self.sentence != other.sentence or self.char_start != other.char_start \
-                or self.char_end != other.char_end
-        except AttributeError:
-            return True
+        return not self.__eq__(other)
 
     def __hash__(self):
-        return hash(self.sentence) + hash(self.char_start) + hash(self.char_end)
+        return hash((self.sentence_id, self.char_start, self.char_end))
+
+    def __getstate__(self):
+        return dict((k, getattr(self, k)) for k in ('id', 'sentence', 'sentence_id', 'char_start', 'char_end', 'meta'))
+
+    def __setstate__(self, state):
+        for k, v in state.iteritems():
+            setattr(self, k, v)
+        self._word_start = None
+        self._word_end   = None
 
     def get_stable_id(self):
         return construct_stable_id(self.sentence, self._get_polymorphic_identity(), self.char_start, self.char_end)
@@ -226,23 +265,25 @@ class TemporarySpan(TemporaryContext):
                 'meta'      : self.meta}
 
     def get_word_start(self):
-        return self.char_to_word_index(self.char_start)
+        # The word index is computed once, and kept along with the char index it was computed for
+        word_start = getattr(self, '_word_start', None)
+        if word_start is None or word_start[0] != self.char_start:
+            word_start = self._word_start = (self.char_start, self.char_to_word_index(self.char_start))
+        return word_start[1]
 
     def get_word_end(self):
-        return self.char_to_word_index(self.char_end)
+        word_end = getattr(self, '_word_end', None)
+        if word_end is None or word_end[0] != self.char_end:
+            word_end = self._word_end = (self.char_end, self.char_to_word_index(self.char_end))
+        return word_end[1]
 
     def get_n(self):
         return self.get_word_end() - self.get_word_start() + 1
 
     def char_to_word_index(self, ci):
         """Given a character-level index (offset), return the index of the **word this char is in**"""
-        i = None
-        for i, co in enumerate(self.sentence.char_offsets):
-            if ci == co:
-                return i
-            elif ci < co:
-                return i-1
-        return i
+        char_offsets = self.sentence.char_offsets
+        return bisect_right(char_offsets, ci) - 1 if len(char_offsets) > 0 else None
 
     def word_to_char_index(self, wi):
         """Given a word-level index, return the character-level index (offset) of the word's start"""
@@ -292,6 +333,32 @@ class TemporarySpan(TemporaryContext):
         return TemporarySpan(**kwargs)
 
 
+class SpanBatch(object):
+    """
+    A batch of TemporarySpans of a Sentence stored as parallel arrays of char_starts and (inclusive) char_ends, for
+    bulk operations during candidate extraction; TemporarySpans are only created when the batch is indexed or
+    iterated over.
+    """
+    def __init__(self, sentence, char_starts, char_ends):
+        self.sentence    = sentence
+        self.char_starts = np.asarray(char_starts, dtype=np.int64)
+        self.char_ends   = np.asarray(char_ends, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.char_starts)
+
+    def __getitem__(self, key):
+        """Returns the TemporarySpan at an integer index, or the sub-batch given by a slice, index array or mask"""
+        if isinstance(key, (int, long, np.integer)):
+            return TemporarySpan(sentence=self.sentence, char_start=int(self.char_starts[key]),
+                                 char_end=int(self.char_ends[key]))
+        return SpanBatch(self.sentence, self.char_starts[key], self.char_ends[key])
+
+    def __iter__(self):
+        for char_start, char_end in zip(self.char_starts.tolist(), self.char_ends.tolist()):
+            yield TemporarySpan(sentence=self.sentence, char_start=char_start, char_end=char_end)
+
+
 class Span(Context, TemporarySpan):
     """
     A span of characters, identified by Context id and character-index start, end (inclusive).
@@ -335,6 +402,169 @@ class Span(Context, TemporarySpan):
     def __hash__(self):
         return id(self)
 
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+class ContextIdIndex(object):
+    """
+    An in-memory index from stable_id to id of the existing Spans of the Document currently being processed,
+    for resolving TemporarySpans in load_ids_or_insert without per-span DB lookups during sentence-ordered
+    candidate extraction.
+
+    The Spans of a Document are loaded with a single query the first time one of its TemporarySpans *may* already
+    exist; after that, its TemporarySpans are resolved in memory. Optionally, a Bloom filter over all Context
+    stable_ids in the DB, as built by build_context_bloom_filter, identifies TemporarySpans which are certainly new,
+    so that Documents without any existing Spans--e.g. on a fresh extraction run--are never queried at all.
+
+    NOTE: Assumes that the same Sentence is not being extracted from by more than one process at a time.
+    """
+    def __init__(self, bloom=None):
+        self.bloom       = bloom
+        self.document_id = None
+        self.loaded      = False
+        self.ids         = {}
+
+    def set_document(self, document_id):
+        """Switch to the Document with id document_id, dropping the index of the previous one"""
+        if document_id != self.document_id:
+            self.document_id = document_id
+            self.loaded      = False
+            self.ids         = {}
+
+    def resolve(self, session, stable_ids):
+        """Returns a dict mapping those of the given stable_ids which exist in the DB to their Context ids"""
+        if self.document_id is None:
+            return _load_context_ids(session, stable_ids)
+        ids = {}
+        for stable_id in stable_ids:
+            if not self.loaded and stable_id not in self.ids and (self.bloom is None or stable_id in self.bloom):
+                self._load_document(session)
+            if stable_id in self.ids:
+                ids[stable_id] = self.ids[stable_id]
+        return ids
+
+    def add(self, ids):
+        """Add newly inserted Contexts, given as a dict mapping stable_id to id"""
+        self.ids.update(ids)
+        if self.bloom is not None:
+            for stable_id in ids:
+                self.bloom.add(stable_id)
+
+    def _load_document(self, session):
+        context, span, sentence = Context.__table__, Span.__table__, Sentence.__table__
+        q = select([context.c.stable_id, context.c.id])
+        q = q.where(context.c.id == span.c.id)
+        q = q.where(span.c.sentence_id == sentence.c.id)
+        q = q.where(sentence.c.document_id == self.document_id)
+        self.ids.update(session.execute(q).fetchall())
+        self.loaded = True
+
+
+def build_context_bloom_filter(session, error_rate=0.01):
+    """
+    Returns a BloomFilter over the stable_ids of all Contexts in the DB, for a ContextIdIndex. It is meant to be
+    built once per extraction run, e.g. by the parent process, and shared by the UDFs.
+    """
+    # Leave headroom for the Contexts inserted during this run
+    n_contexts = session.execute(select([func.count(Context.id)])).scalar()
+    bloom      = BloomFilter(2 * n_contexts + 100000, error_rate=error_rate)
+    res        = session.execute(select([Context.stable_id]))
+    while True:
+        rows = res.fetchmany(10000)
+        if len(rows) == 0:
+            break
+        for stable_id, in rows:
+            bloom.add(stable_id)
+    return bloom
+
+
+def load_ids_or_insert(session, temp_contexts, index=None):
+    """
+    Batch version of TemporaryContext.load_id_or_insert: sets the id of every TemporaryContext in temp_contexts,
+    resolving the ones already in the DB with one SELECT per chunk and inserting the rest with multi-row INSERTs
+    into the context table and the child (e.g. span) tables.
+    TemporaryContexts with equal stable_ids (e.g. the same Span matched for two relation arguments) share an id.
+
+    If a ContextIdIndex is provided, existing ids are resolved through it rather than looked up directly.
+    """
+    # Group the TemporaryContexts that still need an id by stable_id
+    tcs_by_stable_id = defaultdict(list)
+    temp_contexts    = [tc for tc in temp_contexts if tc.id is None]
+    for tc, stable_id in zip(temp_contexts, _get_stable_ids(temp_contexts)):
+        tcs_by_stable_id[stable_id].append(tc)
+    if len(tcs_by_stable_id) == 0:
+        return
+
+    # Resolve the ids of existing Contexts
+    if index is not None:
+        ids = index.resolve(session, tcs_by_stable_id.keys())
+    else:
+        ids = _load_context_ids(session, tcs_by_stable_id.keys())
+    missing = [stable_id for stable_id in tcs_by_stable_id if stable_id not in ids]
+
+    # Insert the missing Contexts, then read back their ids
+    if len(missing) > 0:
+        context_rows = [{'type': tcs_by_stable_id[stable_id][0]._get_table_name(), 'stable_id': stable_id}
+                        for stable_id in missing]
+        batch_size   = rows_per_statement(len(Context.__table__.columns))
+        for i in range(0, len(context_rows), batch_size):
+            session.execute(Context.__table__.insert().values(context_rows[i:i+batch_size]))
+        ids.update(_load_context_ids(session, missing))
+
+        # Insert the rows of the child tables, grouped by table
+        child_rows = defaultdict(list)
+        for stable_id in missing:
+            tc                = tcs_by_stable_id[stable_id][0]
+            insert_args       = tc._get_insert_args()
+            insert_args['id'] = ids[stable_id]
+            child_rows[tc._get_table_name()].append(insert_args)
+        for table_name, rows in child_rows.iteritems():
+            table      = SnorkelBase.metadata.tables[table_name]
+            batch_size = rows_per_statement(len(table.columns))
+            for i in range(0, len(rows), batch_size):
+                session.execute(table.insert().values(rows[i:i+batch_size]))
+        if index is not None:
+            index.add(dict((stable_id, ids[stable_id]) for stable_id in missing))
+
+    for stable_id, tcs in tcs_by_stable_id.iteritems():
+        for tc in tcs:
+            tc.id = ids[stable_id]
+
+
+def _get_stable_ids(temp_contexts):
+    """
+    Returns the stable_ids of temp_contexts, as TemporaryContext.get_stable_id does, but parsing the stable_id of the
+    Sentence of the TemporarySpans only once per Sentence
+    """
+    parent_ids = {}
+    stable_ids = []
+    for tc in temp_contexts:
+        if type(tc).get_stable_id != TemporarySpan.get_stable_id:
+            stable_ids.append(tc.get_stable_id())
+            continue
+        sentence_stable_id = tc.sentence.stable_id
+        if sentence_stable_id not in parent_ids:
+            parent_ids[sentence_stable_id] = split_stable_id(sentence_stable_id)
+        doc_id, _, sentence_char_start, _ = parent_ids[sentence_stable_id]
+        stable_ids.append("%s::%s:%s:%s" % (doc_id, tc._get_polymorphic_identity(),
+                                            sentence_char_start + tc.char_start, sentence_char_start + tc.char_end))
+    return stable_ids
+
+
+def _load_context_ids(session, stable_ids):
+    """Returns a dict mapping those of the given stable_ids which exist in the DB to their Context ids"""
+    stable_ids = list(stable_ids)
+    ids        = {}
+    batch_size = rows_per_statement(1)
+    for i in range(0, len(stable_ids), batch_size):
+        q = select([Context.stable_id, Context.id]).where(Context.stable_id.in_(stable_ids[i:i+batch_size]))
+        ids.update(session.execute(q).fetchall())
+    return ids
+
 
 def split_stable_id(stable_id):
     """
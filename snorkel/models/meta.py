@@ -13,6 +13,16 @@ snorkel_conn_string = os.environ['SNORKELDB'] if 'SNORKELDB' in os.environ and o
 snorkel_postgres = snorkel_conn_string.startswith('postgres')
 
 
+# Max. number of bound parameters per statement (SQLite's default SQLITE_MAX_VARIABLE_NUMBER); multi-row INSERTs and
+# large IN clauses are split into statements of rows_per_statement rows
+MAX_BOUND_PARAMETERS = 999
+
+
+def rows_per_statement(n_columns, n_other=0):
+    """Returns the number of rows of n_columns parameters each which fit in a statement with n_other more parameters"""
+    return (MAX_BOUND_PARAMETERS - n_other) // n_columns
+
+
 # Automatically turns on foreign key enforcement for SQLite
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
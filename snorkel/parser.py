@@ -20,6 +20,9 @@ from .utils import sort_X_on_Y
 
 
 class CorpusParser(UDFRunner):
+    # Clearing deletes all Candidates, and with them their annotations
+    output_table = Candidate.__tablename__
+
     def __init__(self, tok_whitespace=False, split_newline=False, parse_tree=False, fn=None):
         super(CorpusParser, self).__init__(CorpusParserUDF,
                                            tok_whitespace=tok_whitespace,
@@ -1,15 +1,42 @@
 from multiprocessing import Process, JoinableQueue
 from Queue import Empty
 
-from .models.meta import new_sessionmaker, snorkel_conn_string
+from .models import new_annotation_run
+from .models.meta import new_sessionmaker, rows_per_statement, snorkel_conn_string
 from .utils import ProgressBar
 
 
 QUEUE_TIMEOUT = 3
 
+# Number of Context ids per batch loaded by a UDF with a single query, and per IN clause with at most one other
+# parameter
+ID_BATCH_SIZE = rows_per_statement(1, n_other=1)
+
+
+class ContextIdBatch(object):
+    """
+    A batch of ids of Contexts of context_class, given to UDFs in place of the Contexts themselves; each UDF loads
+    its batches with a single query, so that no ORM objects need to be loaded by the caller or pickled between
+    processes.
+    """
+    def __init__(self, context_class, ids):
+        self.context_class = context_class
+        self.ids           = list(ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def load(self, session):
+        """Returns the Contexts of the batch, ordered by id"""
+        return session.query(self.context_class).filter(self.context_class.id.in_(self.ids))\
+            .order_by(self.context_class.id).all()
+
 
 class UDFRunner(object):
     """Class to run UDFs in parallel using simple queue-based multiprocessing setup"""
+    # Name of the table written by the UDF, if any; its AnnotationRun id is renewed before and after each run
+    output_table = None
+
     def __init__(self, udf_class, **udf_init_kwargs):
         self.udf_class       = udf_class
         self.udf_init_kwargs = udf_init_kwargs
@@ -25,6 +52,8 @@ class UDFRunner(object):
         Apply the given UDF to the set of objects xs, either single or multi-threaded, 
         and optionally calling clear() first.
         """
+        self.new_run()
+
         # Clear everything downstream of this UDF if requested
         if clear:
             print "Clearing existing..."
@@ -40,6 +69,30 @@ class UDFRunner(object):
             self.apply_st(xs, progress_bar, clear=clear, count=count, **kwargs)
         else:
             self.apply_mt(xs, parallelism, clear=clear, **kwargs)
+        self.new_run()
+
+    def new_run(self):
+        """Renews the AnnotationRun id of the output table, invalidating anything cached from it"""
+        if self.output_table is not None:
+            SnorkelSession = new_sessionmaker()
+            session = SnorkelSession()
+            new_annotation_run(session, self.output_table)
+            session.commit()
+            session.close()
+
+    def apply_ids(self, context_class, ids=None, batch_size=ID_BATCH_SIZE, **kwargs):
+        """
+        Apply the UDF to the Contexts of context_class with the given ids--by default, all of them--which are
+        handed to the UDF(s) in ContextIdBatches and loaded there. See apply() for the other arguments.
+        """
+        if ids is None:
+            SnorkelSession = new_sessionmaker()
+            session = SnorkelSession()
+            ids = [id for (id,) in session.query(context_class.id).order_by(context_class.id)]
+            session.close()
+        ids = list(ids)
+        self.apply([ContextIdBatch(context_class, ids[i:i+batch_size]) for i in range(0, len(ids), batch_size)],
+                   **kwargs)
 
     def clear(self, session, **kwargs):
         raise NotImplementedError()
@@ -60,15 +113,18 @@ class UDFRunner(object):
                 pb.bar(i)
 
             # Apply UDF and add results to the session
-            for y in udf.apply(x, **kwargs):
-                
-                # Uf UDF has a reduce step, this will take care of the insert; else add to session
-                if hasattr(self.udf_class, 'reduce'):
-                    udf.reduce(y, **kwargs)
-                else:
-                    udf.session.add(y)
+            for z in udf.get_inputs(x):
+                for y in udf.apply(z, **kwargs):
+
+                    # Uf UDF has a reduce step, this will take care of the insert; else add to session
+                    if hasattr(self.udf_class, 'reduce'):
+                        udf.reduce(y, **kwargs)
+                    else:
+                        udf.session.add(y)
 
         # Commit session and close progress bar if applicable
+        if hasattr(self.udf_class, 'reduce'):
+            udf.flush(**kwargs)
         udf.session.commit()
         if pb:
             pb.bar(n)
@@ -110,6 +166,7 @@ class UDFRunner(object):
                         out_queue.task_done()
                     except Empty:
                         break
+                self.reducer.flush(**kwargs)
                 self.reducer.session.commit()
             self.reducer.session.close()
 
@@ -150,19 +207,28 @@ class UDF(Process):
         while True:
             try:
                 x = self.in_queue.get(True, QUEUE_TIMEOUT)
-                for y in self.apply(x, **self.apply_kwargs):
-
-                    # If an out_queue is provided, add to that, else add to session
-                    if self.out_queue is not None:
-                        self.out_queue.put(y, True, QUEUE_TIMEOUT)
-                    else:
-                        self.session.add(y)
+                for z in self.get_inputs(x):
+                    for y in self.apply(z, **self.apply_kwargs):
+
+                        # If an out_queue is provided, add to that, else add to session
+                        if self.out_queue is not None:
+                            self.out_queue.put(y, True, QUEUE_TIMEOUT)
+                        else:
+                            self.session.add(y)
                 self.in_queue.task_done()
             except Empty:
                 break
         self.session.commit()
         self.session.close()
 
+    def get_inputs(self, x):
+        """Returns the objects to apply the UDF to for an input x, loading them if x is a ContextIdBatch"""
+        return x.load(self.session) if isinstance(x, ContextIdBatch) else [x]
+
     def apply(self, x, **kwargs):
         """This function takes in an object, and returns a generator / set / list"""
         raise NotImplementedError()
+
+    def flush(self, **kwargs):
+        """For UDFs with a reduce step which buffers its outputs: writes out the buffer; called before each commit"""
+        pass
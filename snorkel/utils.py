@@ -1,4 +1,7 @@
+import hashlib
+import math
 import re
+import struct
 import sys
 import numpy as np
 import scipy.sparse as sparse
@@ -29,6 +32,32 @@ class ProgressBar(object):
         sys.stdout.flush()
 
 
+class BloomFilter(object):
+    """
+    A simple Bloom filter over strings: membership tests never give false negatives, and give false
+    positives with probability ~error_rate as long as at most capacity items have been added.
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        capacity      = max(1, capacity)
+        self.n_bits   = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, int(round(self.n_bits / float(capacity) * math.log(2))))
+        self.bits     = bytearray((self.n_bits + 7) // 8)
+
+    def _positions(self, item):
+        """Double hashing: derives the n_hashes bit positions of item from a single MD5 digest"""
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(item).digest())
+        return [(h1 + i * h2) % self.n_bits for i in xrange(self.n_hashes)]
+
+    def add(self, item):
+        for p in self._positions(item):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+
 def get_ORM_instance(ORM_class, session, instance):
     """
     Given an ORM class and *either an instance of this class, or the name attribute of an instance
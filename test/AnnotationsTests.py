@@ -0,0 +1,224 @@
+import os, re, shutil, sys, tempfile, unittest
+from functools import partial
+import numpy as np
+import scipy.sparse as sparse
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from snorkel.annotations import *
+from snorkel.annotations import _hash_annotations, _merge_feature_blocks, _to_annotation_matrix
+from snorkel.models import Candidate, LabelKey, SnorkelSession
+
+KEYWORDS = ['cause', 'induce']
+
+def _has_keyword(c):
+    return any(k in c for k in KEYWORDS)
+
+
+class K(object):
+    t = 1
+
+
+class FakeCandidate(object):
+    def __init__(self, id, text):
+        self.id   = id
+        self.text = text
+
+
+def get_text(c):
+    return c.text
+
+def get_tokens(c, lower=False):
+    return (c.text.lower() if lower else c.text).split()
+
+
+class TestLFFingerprint(unittest.TestCase):
+
+    def test_constant(self):
+        def lf(c):
+            return 1 if 'cause' in c else 0
+        fp = lf_fingerprint(lf)
+        self.assertEqual(fp, lf_fingerprint(lf))
+        def lf(c):
+            return 1 if 'induce' in c else 0
+        self.assertNotEqual(fp, lf_fingerprint(lf))
+
+    def test_global_list(self):
+        def lf(c):
+            return 1 if c in KEYWORDS else 0
+        fp = lf_fingerprint(lf)
+        KEYWORDS.append('treat')
+        try:
+            self.assertNotEqual(fp, lf_fingerprint(lf))
+        finally:
+            KEYWORDS.pop()
+        self.assertEqual(fp, lf_fingerprint(lf))
+
+    def test_helper(self):
+        global _has_keyword
+        def lf(c):
+            return 1 if _has_keyword(c) else 0
+        fp, helper = lf_fingerprint(lf), _has_keyword
+        def _has_keyword(c):
+            return any(k in c.lower() for k in KEYWORDS)
+        try:
+            self.assertNotEqual(fp, lf_fingerprint(lf))
+        finally:
+            _has_keyword = helper
+
+    def test_defaults_and_closures(self):
+        def lf(c, label=1):
+            return label if 'cause' in c else 0
+        fp = lf_fingerprint(lf)
+        def lf(c, label=-1):
+            return label if 'cause' in c else 0
+        self.assertNotEqual(fp, lf_fingerprint(lf))
+        def make_lf(label):
+            def lf(c):
+                return label if 'cause' in c else 0
+            return lf
+        self.assertEqual(lf_fingerprint(make_lf(1)), lf_fingerprint(make_lf(1)))
+        self.assertNotEqual(lf_fingerprint(make_lf(1)), lf_fingerprint(make_lf(-1)))
+
+    def test_partials_and_callables(self):
+        def lf(c, label):
+            return label if 'cause' in c else 0
+        self.assertEqual(lf_fingerprint(partial(lf, label=1)), lf_fingerprint(partial(lf, label=1)))
+        self.assertNotEqual(lf_fingerprint(partial(lf, label=1)), lf_fingerprint(partial(lf, label=-1)))
+        class LF(object):
+            def __init__(self, label):
+                self.label = label
+            def __call__(self, c):
+                return self.label if 'cause' in c else 0
+        self.assertEqual(lf_fingerprint(LF(1)), lf_fingerprint(LF(1)))
+        self.assertNotEqual(lf_fingerprint(LF(1)), lf_fingerprint(LF(-1)))
+        self.assertIsNone(lf_fingerprint(len))
+
+    def test_class_attributes(self):
+        # NOTE: Known blind spot; the attributes of classes and other objects referenced by an LF are not hashed
+        def lf(c):
+            return K.t
+        fp  = lf_fingerprint(lf)
+        K.t = 2
+        try:
+            self.assertEqual(fp, lf_fingerprint(lf))
+        finally:
+            K.t = 1
+
+
+class TestBatchFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.candidates = [FakeCandidate(3, "aspirin causes headache"), FakeCandidate(1, "Aspirin treats pain"),
+                           FakeCandidate(2, "no relation")]
+
+    def test_candidate_batch(self):
+        batch = CandidateBatch(self.candidates)
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(batch.ids.tolist(), [3, 1, 2])
+        self.assertIs(batch[1], self.candidates[1])
+        self.assertIs(batch.column(get_tokens, lower=True), batch.column(get_tokens, lower=True))
+        self.assertEqual(batch.column(get_tokens, lower=True)[1], ["aspirin", "treats", "pain"])
+        self.assertEqual(batch.search(get_text, r'^aspirin').tolist(), [True, False, False])
+        self.assertEqual(batch.search(get_text, r'^aspirin', flags=re.I).tolist(), [True, True, False])
+        self.assertEqual(batch.contains(get_tokens, ["causes", "relation"]).tolist(), [True, False, True])
+
+    def test_annotate(self):
+        @batch_lf
+        def lf_batch(batch):
+            return np.where(batch.contains(get_tokens, ["causes"]), 1, 0)
+        def lf_single(c):
+            return -1 if 'treats' in c.text else 0
+        self.assertTrue(lf_batch.batch)
+        udf = AnnotatorUDF(Label, LabelKey, [lf_single, lf_batch])
+        self.assertEqual(sorted(udf._annotate(self.candidates, None)),
+                         [(1, 'lf_batch', 0), (1, 'lf_single', -1), (2, 'lf_batch', 0), (2, 'lf_single', 0),
+                          (3, 'lf_batch', 1), (3, 'lf_single', 0)])
+        self.assertEqual(sorted(udf._annotate(self.candidates, frozenset(['lf_batch']))),
+                         [(1, 'lf_batch', 0), (2, 'lf_batch', 0), (3, 'lf_batch', 1)])
+
+    def test_annotate_length(self):
+        @batch_lf
+        def lf_short(batch):
+            return [1] * (len(batch) - 1)
+        udf = AnnotatorUDF(Label, LabelKey, [lf_short])
+        self.assertRaises(ValueError, list, udf._annotate(self.candidates, None))
+
+
+
+class TestFeatureHashing(unittest.TestCase):
+
+    def test_hash_key_name(self):
+        # The hashes must not depend on the process, e.g. on PYTHONHASHSEED
+        self.assertEqual(hash_key_name('WORD_SEQ[cause]', 1000), 92)
+        self.assertEqual(hash_key_name(u'WORD_SEQ[cause]', 1000), 92)
+        self.assertEqual(hash_key_name(u'caf\xe9', 97), hash_key_name(u'caf\xe9'.encode('utf-8'), 97))
+
+    def test_collisions(self):
+        annotations = [(1, 'a', 1.0), (1, 'b', 2.0), (2, 'a', 0.5)]
+        self.assertEqual(sorted(_hash_annotations(annotations, 1000)), [(1, 681, 2.0), (1, 907, 1.0), (2, 907, 0.5)])
+        self.assertEqual(sorted(_hash_annotations(annotations, 1)), [(1, 0, 3.0), (2, 0, 0.5)])
+
+
+
+class TestFeatureMatrixBlocks(unittest.TestCase):
+
+    def setUp(self):
+        # Blocks as built by FeatureMatrixUDFs, out of candidate id order, each with its own vocabulary
+        self.blocks = [([5, 7], ['b', 'c'], sparse.csr_matrix(np.array([[1., 0.], [2., 3.]]))),
+                       ([1, 2], ['a', 'b'], sparse.csr_matrix(np.array([[4., 0.], [0., 5.]])))]
+
+    def test_merge(self):
+        F = _merge_feature_blocks(self.blocks)
+        self.assertEqual([F.row_index[i] for i in range(4)], [1, 2, 5, 7])
+        self.assertEqual([F.col_index[j] for j in range(3)], ['a', 'b', 'c'])
+        self.assertEqual(F.toarray().tolist(), [[4, 0, 0], [0, 5, 0], [0, 1, 0], [0, 2, 3]])
+        self.assertEqual(F.candidate_index[5], 2)
+
+    def test_merge_key_names(self):
+        F = _merge_feature_blocks(self.blocks, key_names=['c', 'd', 'b'])
+        self.assertEqual([F.col_index[j] for j in range(3)], ['c', 'd', 'b'])
+        self.assertEqual(F.toarray().tolist(), [[0, 0, 0], [0, 0, 5], [0, 0, 1], [3, 0, 2]])
+        self.assertEqual(_merge_feature_blocks([], key_names=['a']).shape, (0, 1))
+
+    def test_file(self):
+        F    = _merge_feature_blocks(self.blocks)
+        root = tempfile.mkdtemp()
+        try:
+            path = os.path.join(root, 'F.npz')
+            save_feature_matrix_file(path, F)
+            G = load_feature_matrix_file(path)
+        finally:
+            shutil.rmtree(root)
+        self.assertEqual(G.toarray().tolist(), F.toarray().tolist())
+        self.assertEqual((G.row_index, G.candidate_index), (F.row_index, F.candidate_index))
+        self.assertEqual((G.col_index, G.key_index), (F.col_index, F.key_index))
+
+
+
+class TestMarginals(unittest.TestCase):
+    SPLIT = 917
+
+    def setUp(self):
+        self.session = SnorkelSession()
+        candidates   = [Candidate(split=self.SPLIT) for _ in range(4)]
+        self.session.add_all(candidates)
+        self.session.commit()
+        self.cids = [c.id for c in candidates]
+
+    def tearDown(self):
+        self.session.query(Candidate).filter(Candidate.split == self.SPLIT).delete()
+        self.session.commit()
+        self.session.close()
+
+    def test_aligned_to_L(self):
+        # Rows of L not in candidate id order, and without the last candidate
+        cids = np.array([self.cids[2], self.cids[0], self.cids[1]])
+        L    = _to_annotation_matrix(csr_LabelMatrix, LabelKey, sparse.csr_matrix((3, 1)), cids, np.array([1]))
+        save_marginals(self.session, L, np.array([0.2, 0.4, 0.6]))
+        self.assertEqual(load_marginals(self.session, L=L).tolist(), [0.2, 0.4, 0.6])
+        marginals = load_marginals(self.session, split=self.SPLIT)
+        self.assertEqual(marginals[:3].tolist(), [0.4, 0.6, 0.2])
+        self.assertTrue(np.isnan(marginals[3]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,8 @@ import os, sys, unittest, cPickle
 from time import sleep
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 from snorkel.candidates import *
+from snorkel.matchers import DictionaryMatch
+from snorkel.models.context import _get_stable_ids
 from snorkel.parser import SentenceParser
 
 DATA_PATH = os.environ['SNORKELHOME'] + '/test/data/'
@@ -33,5 +35,88 @@ class TestCandidateSpace(unittest.TestCase):
         self.assertEqual(len(ngs), 25)
 
 
+class TestNgramOffsets(unittest.TestCase):
+
+    def test_split_pieces(self):
+        sent   = Sentence(text="cow Alpha-3", words=["cow", "Alpha-3"], char_offsets=[0, 4])
+        ngrams = Ngrams(n_max=2)
+        spans  = [ts.get_span() for ts in ngrams.apply(sent)]
+        self.assertEqual(spans, ["cow Alpha-3", "cow", "Alpha-3", "Alpha", "3"])
+        char_starts, char_ends = ngrams.get_offsets(sent)
+        self.assertEqual(list(char_starts), [0, 0, 4, 4, 10])
+        self.assertEqual(list(char_ends), [10, 2, 10, 8, 10])
+
+    def test_short_sentence(self):
+        sent                   = Sentence(text="cow Alpha-3", words=["cow", "Alpha-3"], char_offsets=[0, 4])
+        char_starts, char_ends = Ngrams(n_max=5).get_offsets(sent)
+        self.assertEqual(list(char_starts), [0, 0, 4, 4, 10])
+        self.assertEqual(list(char_ends), [10, 2, 10, 8, 10])
+
+
+class TestDictionaryNgrams(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = Sentence(text="New York City is in New-York State", char_offsets=[0, 4, 9, 14, 17, 20, 29],
+                             words=["New", "York", "City", "is", "in", "New-York", "State"],
+                             lemmas=["new", "york", "city", "be", "in", "new-york", "state"])
+        self.d    = ["new york", "New York City", "York", "is", "I", "be in", "State", "cit"]
+
+    def _assert_same(self, n_max=5, **kwargs):
+        spans   = [ts.get_span() for ts in DictionaryNgrams(self.d, n_max=n_max, **kwargs).apply(self.sent)]
+        matcher = DictionaryMatch(d=self.d, longest_match_only=False, **kwargs)
+        self.assertEqual(spans, [ts.get_span() for ts in matcher.apply(Ngrams(n_max=n_max).apply(self.sent))])
+        return spans
+
+    def test_matches(self):
+        self.assertEqual(self._assert_same(), ["New York City", "New York", "York", "is", "York", "State"])
+        self.assertEqual(self._assert_same(n_max=2), ["New York", "York", "is", "York", "State"])
+
+    def test_options(self):
+        self.assertEqual(self._assert_same(ignore_case=False), ["New York City", "York", "is", "York", "State"])
+        self.assertEqual(self._assert_same(attrib='lemmas'), ["New York City", "New York", "is in", "York", "State"])
+
+
+class TestSpanWordIndexes(unittest.TestCase):
+
+    def test_word_indexes(self):
+        sent = Sentence(text="cow Alpha-3 ate", words=["cow", "Alpha-3", "ate"], char_offsets=[0, 4, 12])
+        span = TemporarySpan(sentence=sent, char_start=6, char_end=14)
+        self.assertEqual((span.get_word_start(), span.get_word_end()), (1, 2))
+        self.assertEqual(span.get_attrib_tokens(), ["Alpha-3", "ate"])
+        span.char_start = 0
+        self.assertEqual(span.get_word_start(), 0)
+
+    def test_span_batch(self):
+        sent  = Sentence(id=1, text="cow Alpha-3", words=["cow", "Alpha-3"], char_offsets=[0, 4],
+                         stable_id="doc::sentence:0:10")
+        batch = SpanBatch(sent, *Ngrams(n_max=2).get_offsets(sent))
+        self.assertEqual(len(batch), 5)
+        self.assertEqual(list(batch)[2], TemporarySpan(sentence=sent, char_start=4, char_end=10))
+        self.assertEqual(_get_stable_ids(batch[batch.char_starts == 4]), ["doc::span:4:10", "doc::span:4:8"])
+        self.assertEqual(_get_stable_ids(batch), [tc.get_stable_id() for tc in batch])
+
+
+class TestSpanPairs(unittest.TestCase):
+
+    def setUp(self):
+        # Sentence with ten 2-char tokens, with offsets 0, 3, 6, ...
+        self.sent = Sentence(text=' '.join(['ab'] * 10), words=['ab'] * 10, char_offsets=range(0, 30, 3))
+
+    def _span(self, i, j):
+        return TemporarySpan(sentence=self.sent, char_start=3*i, char_end=3*j+1)
+
+    def test_pruning(self):
+        spans = [self._span(0, 0), self._span(0, 1), self._span(2, 2), self._span(8, 9)]
+        pairs = list(span_pairs(spans, spans, symmetric_relations=False))
+        self.assertEqual(len(pairs), 5)
+        self.assertNotIn((spans[0], spans[1]), pairs)
+        self.assertIn((spans[0], spans[2]), pairs)
+
+    def test_max_token_distance(self):
+        spans = [self._span(0, 0), self._span(2, 2), self._span(8, 9)]
+        pairs = list(span_pairs(spans, spans, max_token_distance=1))
+        self.assertEqual(set(pairs), set([(spans[0], spans[1]), (spans[1], spans[0])]))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,6 +4,7 @@ sys.path.insert(1, os.path.join(sys.path[0], '..'))
 from snorkel.matchers import *
 from snorkel.parser import SentenceParser
 from snorkel.candidates import Ngrams
+from snorkel.models import Sentence, TemporarySpan
 
 DATA_PATH = os.environ['SNORKELHOME'] + '/test/data/'
 
@@ -59,5 +60,181 @@ class TestMatchers(unittest.TestCase):
         self.assertEqual(matches[0].get_span(), "Burritos and/or tacos")
 
 
+class TestSpanIndex(unittest.TestCase):
+
+    def test_covers(self):
+        index = SpanIndex()
+        index.add(4, 10)
+        index.add(8, 15)
+        index.add(5, 9)
+        self.assertEqual(index.starts, [4, 8])
+        self.assertTrue(index.covers(5, 10))
+        self.assertTrue(index.covers(9, 15))
+        self.assertFalse(index.covers(5, 12))
+        self.assertFalse(index.covers(0, 3))
+
+        # A longer span replaces the spans it contains
+        index.add(0, 20)
+        self.assertEqual((index.starts, index.ends), ([0], [20]))
+
+
+class TestRegexSet(unittest.TestCase):
+
+    def test_match(self):
+        regex_set = RegexSet([r'(a)(b)?c$', r'\d+$', r'(x)\1$', r'foo|bar$'])
+        self.assertEqual(regex_set.match('abc'), 0)
+        self.assertEqual(regex_set.match('123'), 1)
+        self.assertEqual(regex_set.match('xx'), 2)
+        self.assertEqual(regex_set.match('food'), 3)
+        self.assertIsNone(regex_set.match('x'))
+
+    def test_named_groups(self):
+        regex_set = RegexSet([r'(?P<num>\d+) mg$', r'(?P<num>\d+) ml$', r'(?P<unit>k?g)$'])
+        self.assertEqual(regex_set.match('5 mg'), 0)
+        self.assertEqual(regex_set.match('5 ml'), 1)
+        self.assertEqual(regex_set.match('kg'), 2)
+        self.assertIsNone(regex_set.match('5 l'))
+        matcher = Union(RegexMatchSpan(rgx=r'(?P<num>\d+) mg'), RegexMatchSpan(rgx=r'(?P<num>\d+) ml'))
+        sent    = Sentence(text="take 5 ml", words=["take", "5", "ml"], char_offsets=[0, 5, 7])
+        self.assertEqual([s.get_span() for s in matcher.apply(Ngrams(n_max=2).apply(sent))], ["5 ml"])
+
+
+class TestDictionaryMatch(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = Sentence(text="New York City is in New-York State", char_offsets=[0, 4, 9, 14, 17, 20, 29],
+                             words=["New", "York", "City", "is", "in", "New-York", "State"],
+                             lemmas=["new", "york", "city", "be", "in", "new-york", "state"])
+        self.d    = ["new york", "New York City", "York", "is", "I", "be in", "State", "cit"]
+
+    def _assert_same(self, matcher, n_max=4):
+        ngrams  = Ngrams(n_max=n_max)
+        matches = [s.get_span() for s in matcher.apply_ngrams(self.sent, *ngrams.get_offsets(self.sent))]
+        self.assertEqual(matches, [s.get_span() for s in matcher.apply(ngrams.apply(self.sent))])
+        return matches
+
+    def test_trie(self):
+        trie = DictionaryTrie(self.d)
+        self.assertTrue("new york city" in trie)
+        self.assertTrue("i" in trie)
+        self.assertFalse("new" in trie)
+        self.assertFalse("new york c" in trie)
+        self.assertEqual(list(trie.find(self.sent)), [(0, 1), (0, 2), (1, 1), (3, 3), (6, 6)])
+        self.assertEqual(list(trie.find(self.sent, n_max=2)), [(0, 1), (1, 1), (3, 3), (6, 6)])
+        trie = DictionaryTrie(self.d, ignore_case=False)
+        self.assertFalse("new york city" in trie)
+        self.assertEqual(list(trie.find(self.sent)), [(0, 2), (1, 1), (3, 3), (6, 6)])
+
+    def test_mask(self):
+        matches = self._assert_same(DictionaryMatch(d=self.d, longest_match_only=False))
+        self.assertEqual(matches, ["New York City", "New York", "York", "is", "York", "State"])
+        self.assertEqual(self._assert_same(DictionaryMatch(d=self.d)), ["New York City", "is", "York", "State"])
+        self._assert_same(DictionaryMatch(d=self.d, longest_match_only=False), n_max=2)
+
+    def test_options(self):
+        self.assertEqual(self._assert_same(DictionaryMatch(d=self.d, ignore_case=False, longest_match_only=False)),
+                         ["New York City", "York", "is", "York", "State"])
+        self.assertEqual(self._assert_same(DictionaryMatch(d=self.d, attrib='lemmas', longest_match_only=False)),
+                         ["New York City", "New York", "is in", "York", "State"])
+        matches = self._assert_same(DictionaryMatch(d=self.d, reverse=True, longest_match_only=False))
+        self.assertEqual(len(matches), len(list(Ngrams(n_max=4).apply(self.sent))) - 6)
+        self.assertTrue("New York" not in matches and "City is" in matches)
+
+
+class TestEntityMatchers(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = Sentence(text="John Smith met Mary on Monday", words=["John", "Smith", "met", "Mary", "on", "Monday"],
+                             char_offsets=[0, 5, 11, 15, 20, 23], ner_tags=["PERSON", "PERSON", "O", "PERSON", "O", "DATE"])
+
+    def test_segment_index(self):
+        index = SegmentIndex(self.sent.ner_tags)
+        self.assertEqual(index.get_tags(), ["PERSON", "O", "PERSON", "O", "DATE"])
+        self.assertEqual(index.starts.tolist(), [0, 2, 3, 4, 5])
+        self.assertEqual(index.ends.tolist(), [1, 2, 3, 4, 5])
+        self.assertEqual(index.run_ids.tolist(), [0, 0, 1, 2, 3, 4])
+        self.assertEqual(list(index.segments("PERSON")), [(0, 1), (3, 3)])
+        self.assertIs(get_segment_index(self.sent, ignore_case=True), get_segment_index(self.sent, ignore_case=True))
+        self.assertEqual(get_segment_index(self.sent, ignore_case=True).get_tags(), ["person", "o", "person", "o", "date"])
+        index = get_segment_index(self.sent)
+        self.sent.ner_tags = ["PERSON"] * 6
+        self.assertIsNot(get_segment_index(self.sent), index)
+        self.assertEqual(get_segment_index(self.sent).get_tags(), ["PERSON"])
+
+    def test_matches(self):
+        pm      = PersonMatcher()
+        ngrams  = Ngrams(n_max=3)
+        matches = list(pm.apply_ngrams(self.sent, *ngrams.get_offsets(self.sent)))
+        self.assertEqual([s.get_span() for s in matches], ["John Smith", "Mary"])
+        matcher = Union(DateMatcher(), pm)
+        self.assertEqual(len(list(matcher.apply_ngrams(self.sent, *ngrams.get_offsets(self.sent)))), 3)
+
+    def test_mixed_case(self):
+        self.sent.ner_tags = ["PERSON", "Person", "O", "person", "O", "Date"]
+        ngrams = Ngrams(n_max=3)
+        for pm, spans in [(PersonMatcher(), ["John Smith", "Mary"]), (PersonMatcher(ignore_case=False), ["John"])]:
+            matches = list(pm.apply_ngrams(self.sent, *ngrams.get_offsets(self.sent)))
+            self.assertEqual([s.get_span() for s in matches], spans)
+            self.assertEqual([s.get_span() for s in pm.apply(ngrams.apply(self.sent))], spans)
+            self.assertEqual([s.get_span() for s in pm.get_segments(self.sent, n_max=3)], spans)
+
+    def test_segments(self):
+        self.sent.ner_tags = ["PERSON", "PERSON", "PERSON", "PERSON", "O", "DATE"]
+        for n_max in (1, 2, 3, 4, 5):
+            ngrams  = Ngrams(n_max=n_max)
+            for m in (PersonMatcher(), DateMatcher()):
+                matches = sorted(s.get_span() for s in m.apply_ngrams(self.sent, *ngrams.get_offsets(self.sent)))
+                self.assertEqual(sorted(s.get_span() for s in m.get_segments(self.sent, n_max=n_max)), matches)
+        spans = [s.get_span() for s in PersonMatcher().get_segments(self.sent, n_max=3)]
+        self.assertEqual(spans, ["John Smith met", "Smith met Mary"])
+
+
+class TestApplyNgrams(unittest.TestCase):
+
+    def setUp(self):
+        self.sent   = Sentence(text="a b c", words=["a", "b", "c"], char_offsets=[0, 2, 4])
+        self.ngrams = Ngrams(n_max=2)
+
+    def test_lambda_spans(self):
+        seen    = []
+        matcher = LambdaFunctionMatch(func=lambda c: seen.append(c) or True, longest_match_only=False)
+        matches = list(matcher.apply_ngrams(self.sent, *self.ngrams.get_offsets(self.sent)))
+        self.assertEqual([c.get_span() for c in seen], ["a b", "b c", "a", "b", "c"])
+        self.assertEqual(len(set(map(id, seen))), 5)
+        self.assertEqual(matches, seen)
+
+    def test_is_pure(self):
+        dm = DictionaryMatch(d=['a'])
+        self.assertTrue(Union(dm, Concat(dm, PersonMatcher())).is_pure())
+        self.assertFalse(Union(dm, LambdaFunctionMatch(func=bool)).is_pure())
+
+
+class TestMatcherPlan(unittest.TestCase):
+
+    def test_memoization(self):
+        sent  = Sentence(text="a b a b", words=["a", "b", "a", "b"], char_offsets=[0, 2, 4, 6])
+        calls = []
+        def f(c):
+            calls.append((c.char_start, c.char_end))
+            return c.get_span() in ('a', 'b')
+        lm      = LambdaFunctionMatch(func=f)
+        matcher = Concat(lm, lm, longest_match_only=False)
+        matches = list(matcher.apply(Ngrams(n_max=4).apply(sent)))
+        self.assertEqual([m.get_span() for m in matches], ["a b", "b a", "a b"])
+        self.assertEqual(len(calls), len(set(calls)))
+
+    def test_compile(self):
+        dm = DictionaryMatch(d=['a'])
+        self.assertIsNone(Union(dm, RegexMatchSpan(rgx='b')).compile())
+        self.assertIsNotNone(Union(dm, Concat(dm, dm)).compile())
+
+    def test_abandoned_apply(self):
+        sent    = Sentence(text="a a b", words=["a", "a", "b"], char_offsets=[0, 2, 4])
+        matcher = Concat(DictionaryMatch(d=['a']), DictionaryMatch(d=['a', 'b']))
+        matches = matcher.apply(Ngrams(n_max=3).apply(sent))
+        self.assertEqual(next(matches).get_span(), "a a")
+        self.assertTrue(matcher.f(TemporarySpan(sentence=sent, char_start=2, char_end=4)))
+
+
 if __name__ == '__main__':
     unittest.main()